@@ -0,0 +1,4 @@
+"""
+Offline benchmarks for the hot paths of the collection DB. Run them with
+"python -m benchmarks" (see "python -m benchmarks -h").
+"""
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# Written by Gem Newman. This work is licensed under a Creative Commons
+# Attribution-ShareAlike 4.0 International License.
+
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime
+from os import environ, path, remove
+from statistics import median
+from time import perf_counter
+import json, platform, sqlite3, sys
+
+
+USER = 'benchmark'
+
+FILTERS = [
+    ('none', {}),
+    ('color', {'color': ['Red']}),
+    ('type', {'type': ['Creature']}),
+    ('set', {'set': ['Synthetic Set 0']}),
+    ('owned', {'collection': ['Owned']}),
+    ('wanted', {'collection': ['Wanted']})
+]
+GROUPS = [None, 'set', 'color', 'type']
+
+
+def measure(name, function, repeat, queries):
+    """
+    Times a function (after calling it once to warm up any caches). Returns a
+    dict with the fastest, median, and slowest times in seconds, and the
+    number of SQL statements executed by the last run.
+    """
+    function()
+
+    times = []
+    for _ in range(repeat):
+        queries[0] = 0
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+
+    result = {
+        'name': name,
+        'runs': repeat,
+        'min': min(times),
+        'median': median(times),
+        'max': max(times),
+        'queries': queries[0]
+    }
+    print('{name}: {median:.4f}s median, {queries} queries'.format(**result),
+          file=sys.stderr)
+
+    return result
+
+
+def run(args):
+    """
+    Builds a scratch DB containing a synthetic collection and times the hot
+    paths against it. Returns the results as a dict.
+    """
+    # The app reads its configuration (and creates the DB) when imported.
+    environ['CARDS_CONFIG'] = 'benchmarks.config'
+    if args.dir:
+        environ['CARDS_BENCHMARK_DIR'] = args.dir
+
+    from benchmarks import config
+
+    file_name = config.SQLALCHEMY_DATABASE_URI[len('sqlite:///'):]
+    if path.exists(file_name):
+        remove(file_name)
+
+    from sqlalchemy import event
+    from cards import app, db, controller
+    from cards.models import User, Edition, Card, Set
+    from benchmarks.generate import Collection
+
+    collection = Collection(args.editions, seed=args.seed)
+
+    start = perf_counter()
+    collection.write(USER)
+    generated = perf_counter() - start
+
+    # Cards from the collection (to update), and cards that aren't in it yet.
+    step = max(collection.cards // args.sample, 1)
+    sample = list(range(0, collection.cards, step))[:args.sample]
+    extra = list(range(collection.cards, collection.cards + args.sample))
+
+    # Card data comes from the local provider (configured in config.py), so
+    # the cards it can look up are written to its dataset. Names that differ
+    # only by number look like typos of each other, so the new cards also need
+    # to be in the dataset to be known names.
+    collection.write_dataset(config.LOCAL_DATA_DIR, sample + extra)
+
+    queries = [0]
+
+    def count(*args, **kwargs):
+        queries[0] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+
+    # Requests through the test client end by removing the session, so the
+    # user is looked up again for each run.
+    user = lambda: User.query.get(USER)
+    page_size = app.config.get('PAGE_SIZE')
+    results = []
+
+    def fetch(filters, group, **kwargs):
+        return lambda: controller.fetch(
+            user(), {k: list(v) for k, v in filters.items()}, group,
+            page_size=page_size, **kwargs
+        )
+
+    for filter_name, filters in FILTERS:
+        for group in GROUPS:
+            results.append(measure(
+                'fetch[filter={},group={}]'.format(filter_name, group),
+                fetch(filters, group), args.repeat, queries
+            ))
+
+    # Deep pages, found by offset and by cursor.
+    cards, page = controller.fetch(user(), {}, page_size=page_size)
+    middle = max(page['pages'] // 2, 1)
+    results.append(measure(
+        'fetch[page={},offset]'.format(middle),
+        fetch({}, None, page_number=middle), args.repeat, queries
+    ))
+
+    if middle > 1:
+        cards, page = controller.fetch(
+            user(), {}, page_size=page_size, page_number=middle - 1
+        )
+        results.append(measure(
+            'fetch[page={},cursor]'.format(middle),
+            fetch({}, None, page_number=middle, cursor=page['next']),
+            args.repeat, queries
+        ))
+
+    # Pages, rendered through the test client.
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = session['_user_id'] = USER
+        session['_fresh'] = True
+
+    name = collection.card(sample[0])['name']
+
+    for route in ['/browse', '/details?card={}'.format(name),
+                  '/search?q=titan', '/stats']:
+        def get(route=route):
+            r = client.get(route)
+            if r.status_code != 200:
+                raise Exception('GET {} returned {}.'
+                                .format(route, r.status_code))
+
+        results.append(measure(
+            'GET {}'.format(route.split('?')[0]), get, args.repeat, queries
+        ))
+
+    # Writes.
+    names = [collection.card(i)['name'] for i in sample]
+    def add_cards():
+        for name in names[:10]:
+            controller.add_card(user(), name)
+
+    results.append(measure('add_card', add_cards, args.repeat, queries))
+
+    csv_file = path.join(config.scratch, 'cards-benchmark.csv')
+    collection.write_csv(csv_file, sample + extra)
+    def import_csv():
+        for error in controller.import_csv(user(), csv_file):
+            raise Exception('Unable to import {}: {}'.format(*error))
+
+    results.append(measure('import_csv', import_csv, args.repeat, queries))
+
+    return {
+        'started': datetime.utcnow().isoformat(),
+        'scale': {
+            'editions': Edition.query.count(),
+            'cards': Card.query.count(),
+            'sets': Set.query.count(),
+            'sample': len(sample),
+            'generate_seconds': generated
+        },
+        'settings': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform()
+        },
+        'results': results
+    }
+
+
+if __name__ == '__main__':
+    description = ("Times the hot paths of the collection DB against a "
+                   "synthetic collection in a scratch DB, and writes the "
+                   "results as JSON.")
+    parser = ArgumentParser(prog='python -m benchmarks',
+                            description=description)
+    parser.add_argument("-e", "--editions", help="Approximate number of "
+                        "editions to generate. Defaults to 10000.", type=int,
+                        default=10000)
+    parser.add_argument("-r", "--repeat", help="Number of timed runs of each "
+                        "benchmark. Defaults to 5.", type=int, default=5)
+    parser.add_argument("-s", "--sample", help="Number of cards used by the "
+                        "add_card and import_csv benchmarks. Defaults to 100.",
+                        type=int, default=100)
+    parser.add_argument("--seed", help="Seed for the generator. Defaults to "
+                        "0.", type=int, default=0)
+    parser.add_argument("-d", "--dir", help="Directory for the scratch DB. "
+                        "Defaults to the temp directory.")
+    parser.add_argument("-o", "--output", help="File to write the results to. "
+                        "Defaults to standard output.")
+    args = parser.parse_args()
+
+    # The app reports its progress on standard output, so keep that clear for
+    # the results.
+    with redirect_stdout(sys.stderr):
+        results = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
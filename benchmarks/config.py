@@ -0,0 +1,29 @@
+from os import environ, path
+from tempfile import gettempdir
+
+from sample_config import *
+
+
+# The sample configuration, with everything that would touch real data or the
+# network pointed elsewhere. The scratch DB and the local card dataset are
+# written to CARDS_BENCHMARK_DIR (default: the temp directory).
+scratch = environ.get('CARDS_BENCHMARK_DIR', gettempdir())
+
+# Web Server
+WTF_CSRF_ENABLED = False
+
+# SQLAlchemy
+SQLALCHEMY_DATABASE_URI = 'sqlite:///{}'.format(
+    path.join(scratch, 'cards-benchmark.db')
+)
+
+# Card Data (written by the generator)
+CARD_PROVIDER = 'local'
+LOCAL_DATA_DIR = path.join(scratch, 'cards-benchmark-data')
+
+# Card Catalog (the dataset has its own)
+CATALOG_FILE = None
+
+# Prices (none in the dataset)
+PRICE_TTL = 60 * 60 * 24 * 365
+PRICE_REQUEST_TIMEOUT = 0
@@ -0,0 +1,196 @@
+from datetime import date, timedelta
+from os import makedirs, path
+from random import Random
+import csv, json
+
+from cards import db, stats, controller
+from cards.models import User, Set, Card, Edition, COLOR_MASK, TYPE_MASK, \
+    set_to_byte
+
+
+ADJECTIVES = ['Ancient', 'Blazing', 'Cunning', 'Dread', 'Elvish', 'Feral',
+              'Gilded', 'Hallowed', 'Infernal', 'Jade', 'Keening', 'Lunar',
+              'Molten', 'Noble', 'Ornate', 'Primal', 'Quiet', 'Radiant',
+              'Savage', 'Tidal', 'Unyielding', 'Vengeful', 'Wild', 'Zealous']
+NOUNS = ['Angel', 'Behemoth', 'Charm', 'Drake', 'Edict', 'Familiar', 'Golem',
+         'Hydra', 'Invocation', 'Juggernaut', 'Knight', 'Lotus', 'Mystic',
+         'Nexus', 'Oracle', 'Phoenix', 'Reclamation', 'Sphinx', 'Titan',
+         'Uprising', 'Vampire', 'Wurm', 'Zombie']
+RARITIES = ['common', 'common', 'common', 'uncommon', 'uncommon', 'rare',
+            'mythic']
+SYMBOLS = {'White': 'W', 'Blue': 'U', 'Black': 'B', 'Red': 'R', 'Green': 'G'}
+
+# Rows inserted per statement when writing the collection.
+BATCH_SIZE = 10000
+
+
+class Collection:
+    """
+    A synthetic collection of about the specified number of editions. Each
+    card is generated from its index and the seed alone, so any card can be
+    rebuilt later (for the local card dataset, for example) without keeping
+    them all in memory.
+    """
+    def __init__(self, editions, seed=0, printings=3, set_size=250):
+        self.seed = seed
+        self.printings = min(printings, 8)
+        self.cards = max(editions // self.printings, 1)
+        self.sets = max(editions // set_size, 1)
+
+    def set_name(self, j):
+        return 'Synthetic Set {}'.format(j)
+
+    def set_code(self, j):
+        code = ''
+        while True:
+            j, digit = divmod(j, 36)
+            code = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'[digit] + code
+            if not j:
+                return 'X' + code.rjust(3, '0')
+
+    def release_date(self, j):
+        return date(1993, 8, 5) + timedelta(days=7 * j)
+
+    def card(self, i):
+        """
+        Returns card number i, in the format returned by DeckBrew, with the
+        number of copies wanted and owned (of each edition) added.
+        """
+        rng = Random('{}-{}'.format(self.seed, i))
+
+        colors = rng.sample(sorted(COLOR_MASK), rng.choice([0, 1, 1, 1, 2]))
+        cost = '{{{}}}'.format(rng.randint(0, 5)) + ''.join(
+            '{{{}}}'.format(SYMBOLS[c]) for c in colors
+        )
+        count = min(rng.randint(1, 2 * self.printings - 1), self.sets)
+
+        return {
+            'name': '{} {} {}'.format(
+                rng.choice(ADJECTIVES), rng.choice(NOUNS), i
+            ),
+            'colors': [c.lower() for c in colors],
+            'types': [rng.choice(sorted(TYPE_MASK)).lower()],
+            'subtypes': [],
+            'cost': cost,
+            'text': 'When this enters the battlefield, draw a card.',
+            'power': None,
+            'toughness': None,
+            'want': rng.randint(0, 4),
+            'editions': [
+                {
+                    'set': self.set_name(j),
+                    'set_id': self.set_code(j),
+                    'multiverse_id': i * 16 + k + 1,
+                    'number': str(rng.randint(1, 300)),
+                    'rarity': rng.choice(RARITIES),
+                    'layout': 'normal',
+                    'have': rng.choice([0, 0, 1, 1, 2, 4])
+                }
+                for k, j in enumerate(rng.sample(range(self.sets), count))
+            ]
+        }
+
+    def write(self, user_id):
+        """
+        Writes the whole collection to the (empty) DB for a new user, and
+        builds its statistics.
+        """
+        db.session.add(User(id=user_id, name=user_id))
+        db.session.commit()
+
+        insert(Set, [
+            {'id': j + 1, 'code': self.set_code(j), 'name': self.set_name(j),
+             'release_date': self.release_date(j), 'user_id': user_id}
+            for j in range(self.sets)
+        ])
+
+        cards = []
+        editions = []
+        for i in range(self.cards):
+            card = self.card(i)
+            cards.append({
+                'id': i + 1,
+                'name': card['name'],
+                'color_byte': set_to_byte(
+                    COLOR_MASK, {c.capitalize() for c in card['colors']}
+                ),
+                'type_byte': set_to_byte(
+                    TYPE_MASK, {t.capitalize() for t in card['types']}
+                ),
+                'type_line': card['types'][0].capitalize(),
+                'text': card['text'],
+                'cost': card['cost'],
+                'want': card['want'],
+                'important': False,
+                'uncertain': False,
+                'user_id': user_id
+            })
+            editions.extend(
+                {
+                    'multiverse_id': e['multiverse_id'],
+                    'collector_number': e['number'],
+                    'rarity': controller.RARITY[e['rarity']],
+                    'have': e['have'],
+                    'user_id': user_id,
+                    'card_id': i + 1,
+                    'set_id': int(e['set_id'][1:], 36) + 1
+                }
+                for e in card['editions']
+            )
+
+            if len(editions) >= BATCH_SIZE:
+                insert(Card, cards)
+                insert(Edition, editions)
+                cards, editions = [], []
+
+        insert(Card, cards)
+        insert(Edition, editions)
+
+        stats.rebuild(User.query.get(user_id))
+        db.session.commit()
+
+    def write_dataset(self, directory, indices):
+        """
+        Writes the cards with the specified indices, and the release dates of
+        every set, to a directory in the format read by the local provider.
+        """
+        makedirs(directory, exist_ok=True)
+
+        with open(path.join(directory, 'cards.json'), 'w') as f:
+            cards = []
+            for i in indices:
+                card = self.card(i)
+                del card['want']
+                for e in card['editions']:
+                    del e['have']
+                cards.append(card)
+
+            json.dump(cards, f)
+
+        with open(path.join(directory, 'release_dates.json'), 'w') as f:
+            json.dump({self.set_name(j): self.release_date(j).isoformat()
+                       for j in range(self.sets)}, f)
+
+    def write_csv(self, file_name, indices):
+        """
+        Writes the cards with the specified indices to a CSV file in the format
+        read by controller.import_csv.
+        """
+        with open(file_name, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(controller.CSV_COLUMNS)
+
+            for i in indices:
+                card = self.card(i)
+
+                for n, e in enumerate(card['editions']):
+                    writer.writerow([
+                        '', '', e['set'], card['name'], '',
+                        card['want'] if n == 0 else 0, e['have'], 0, ''
+                    ])
+
+
+def insert(model, rows):
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
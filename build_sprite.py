@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Written by Gem Newman. This work is licensed under a Creative Commons
+# Attribution-ShareAlike 4.0 International License.
+
+
+from argparse import ArgumentParser
+from os import path, listdir
+
+from PIL import Image
+
+
+STATIC = path.join(path.dirname(path.abspath(__file__)), 'cards', 'static')
+EXCLUDE = ['icon', 'mana', 'mana-colorless', 'mana-symbols']
+
+
+def build(height, display_height):
+    """
+    Combines the individual mana symbol images into a single sprite sheet
+    (mana-symbols.png), and writes the stylesheet that displays each symbol
+    from it (mana.css).
+    """
+    symbols = sorted(
+        f[:-len('.png')] for f in listdir(STATIC)
+        if f.endswith('.png') and f[:-len('.png')] not in EXCLUDE
+    )
+
+    images = []
+    for symbol in symbols:
+        image = Image.open(path.join(STATIC, symbol + '.png')).convert('RGBA')
+        width = round(image.width * height / image.height)
+        images.append((symbol, image.resize((width, height), Image.LANCZOS)))
+
+    sprite = Image.new('RGBA', (sum(i.width for s, i in images), height))
+    scale = display_height / height
+
+    rules = [
+        '@charset "UTF-8";',
+        '',
+        '/* Generated by build_sprite.py. */',
+        '.mana-symbol {{ display: inline-block; height: {}px; '
+        'background-image: url("mana-symbols.png"); '
+        'background-size: {:g}px {}px; background-repeat: no-repeat; }}'
+        .format(display_height, round(sprite.width * scale, 2), display_height)
+    ]
+
+    x = 0
+    for symbol, image in images:
+        sprite.paste(image, (x, 0))
+        rules.append(
+            '.mana-{} {{ width: {:g}px; background-position: -{:g}px 0px; }}'
+            .format(symbol, round(image.width * scale, 2), round(x * scale, 2))
+        )
+        x += image.width
+
+    sprite.save(path.join(STATIC, 'mana-symbols.png'), optimize=True)
+
+    with open(path.join(STATIC, 'mana.css'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(rules) + '\n')
+
+    print('Combined {} mana symbols.'.format(len(images)))
+
+
+if __name__ == '__main__':
+    description = "Builds the mana symbol sprite sheet and its stylesheet."
+    parser = ArgumentParser(description=description)
+    parser.add_argument("-s", "--size", help="Defines the height (in pixels) "
+                        "of the symbols in the sprite sheet. Defaults to 30.",
+                        type=int, default=30)
+    parser.add_argument("-d", "--display", help="Defines the height (in "
+                        "pixels) at which the symbols are displayed. Defaults "
+                        "to 15.", type=int, default=15)
+    args = parser.parse_args()
+
+    build(args.size, args.display)
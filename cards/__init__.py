@@ -1,10 +1,11 @@
+from os import environ
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.login import LoginManager
 
 
 app = Flask(__name__)
-app.config.from_object('config')
+app.config.from_object(environ.get('CARDS_CONFIG', 'config'))
 db = SQLAlchemy(app)
 
 lm = LoginManager()
@@ -16,8 +17,12 @@ lm.login_view = 'login'
 # 1. Initialize the SQLAlchemy object.
 # 2. Import the models. (The schema will need to import the SQLAlchemy object.)
 # 3. Ensure that the tables are created. (Models must be imported first.)
+# 4. Add any columns and indexes that existing tables are missing.
 from cards import models
 db.create_all()
+models.migrate()
+models.create_search_index()
+models.create_have_triggers()
 
 
-from cards import views
+from cards import views, api, metrics
@@ -0,0 +1,149 @@
+from gzip import compress
+from hashlib import sha1
+from flask import request, jsonify, abort
+from flask.ext.login import current_user, login_required
+
+from cards import app, db, controller
+from cards.models import User, Set, Card, Edition
+
+
+# Columns the collection can be sorted by (as a comma-separated list).
+SORTS = {
+    'name': Card.name,
+    'set': Set.name,
+    'release_date': Set.release_date.desc(),
+    'number': Edition.collector_number,
+    'rarity': Edition.rarity,
+    'have': Edition.have,
+    'need': Card.need.desc()
+}
+
+
+@app.route('/api/cards')
+@login_required
+def api_cards():
+    """
+    Returns the user's editions matching the filters provided, as JSON. Takes
+    the same filters as the browse page ("color", "type", "set", and
+    "collection", each a |-separated list), as well as "group", "sort",
+    "page", "page_size" (default PAGE_SIZE), and "cursor" (the "next" value
+    of the previous page).
+    """
+    filters = {
+        key: [v for value in request.args.getlist(key)
+              for v in value.split('|') if v]
+        for key in ['color', 'type', 'set', 'collection']
+    }
+    group = request.args.get('group')
+    cursor = request.args.get('cursor')
+
+    try:
+        sort = request.args.get('sort')
+        if sort:
+            sort = [SORTS[s] for s in sort.split(',')] + [Edition.id]
+
+        page_number = int(request.args.get('page', 1))
+        if page_number < 1:
+            raise ValueError('page must be at least 1')
+        if cursor:
+            controller.decode_cursor(cursor)
+        page_size = int(
+            request.args.get('page_size', app.config.get('PAGE_SIZE') or 0)
+        )
+        if page_size < 0:
+            raise ValueError('page_size must not be negative')
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': 'Invalid parameter: {}'.format(e)}), 400
+
+    if sort and cursor:
+        return jsonify(
+            {'error': 'Cursors can only be used with the default sort.'}
+        ), 400
+
+    def build():
+        cards, page = controller.fetch(
+            current_user, filters, group, sort, page_size=page_size or None,
+            page_number=page_number, cursor=cursor
+        )
+
+        if group:
+            cards = {name: [edition_dict(e) for e in editions]
+                     for name, editions in cards.items()}
+        else:
+            cards = [edition_dict(e) for e in cards]
+
+        return {'cards': cards, 'page': page}
+
+    return conditional(build)
+
+
+@app.route('/api/cards/<path:name>')
+@login_required
+def api_card(name):
+    """
+    Returns the details of one of the user's cards (and all of its editions),
+    as JSON.
+    """
+    def build():
+        card = current_user.cards.filter(Card.name == name).scalar()
+        if not card:
+            abort(404)
+
+        return card.details()
+
+    return conditional(build)
+
+
+def edition_dict(edition):
+    return {
+        'name': edition.card.name,
+        'color': edition.card.color,
+        'type': edition.card.type,
+        'cost': edition.card.cost,
+        'set': edition.set.name,
+        'collector_number': edition.collector_number,
+        'rarity': edition.rarity,
+        'have': edition.have,
+        'have_total': edition.card.have,
+        'want': edition.card.want,
+        'need': edition.card.need
+    }
+
+
+def collection_version(user):
+    """
+    Returns the version number of the user's collection. This is read from the
+    DB rather than from the user object, which may be out of date.
+    """
+    return db.session.query(User.version).filter(User.id == user.id).scalar()
+
+
+def conditional(build):
+    """
+    Returns a JSON response containing whatever build returns, with a strong
+    ETag derived from the version of the user's collection and the request
+    URL. If the client already has that version (going by If-None-Match), a
+    304 is returned without calling build at all. Responses are gzipped if
+    the client accepts it.
+    """
+    gzipped = 'gzip' in request.accept_encodings
+
+    etag = sha1('{}|{}|{}|{}'.format(
+        current_user.id, collection_version(current_user), request.full_path,
+        'gzip' if gzipped else 'identity'
+    ).encode('utf-8')).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+
+        if gzipped:
+            response.set_data(compress(response.get_data()))
+            response.headers['Content-Encoding'] = 'gzip'
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+    return response.make_conditional(request)
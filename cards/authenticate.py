@@ -1,41 +1,223 @@
+from queue import Queue
+from threading import Lock
+from time import time
 from ldap3 import Server, Connection
+from ldap3.core.exceptions import LDAPException
+from ldap3.utils.conv import escape_filter_chars
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
 
-from cards import app
+from cards import app, db
 from cards.models import User
 
 
+# How often directory entries and users were found in their caches, and how
+# often LDAP (or the DB) had to be asked instead.
+counters = {'directory_hits': 0, 'directory_misses': 0, 'user_hits': 0,
+            'user_misses': 0}
+
+# Functions called with the kind of operation ("search" or "bind"), whether
+# it succeeded, and the duration in seconds of every LDAP request.
+listeners = []
+
+_lock = Lock()
+
+# Anonymous connections used to look users up, kept open between logins.
+# The pool holds LDAP_POOL_SIZE slots, each either an open connection or None
+# (not opened yet, or closed after an error).
+_server = None
+_pool = None
+_pool_lock = Lock()
+
+# Directory entries (distinguished name, name, and email address) and users,
+# by user ID, with the times they expire.
+_directory = {}
+_users = {}
+
+
 def authenticate(username, password):
-    user = None
+    """
+    Looks the user up in LDAP (or the directory cache) and binds as them to
+    check the password. Returns a new User if that succeeds, otherwise None.
+    """
+    entry = lookup(username)
+    if entry is None:
+        return None
 
-    # Initial connection to the LDAP server.
-    server = Server(app.config['LDAP_URI'])
-    connection = Connection(server)
+    distinguished_name, name, email = entry
+
+    # The password is checked against LDAP every time, with a connection of
+    # its own.
+    connection = Connection(get_server(), user=distinguished_name,
+                            password=password.encode('iso8859-1'))
+    start = time()
+    succeeded = False
 
     try:
-        if not connection.bind(): return None
+        succeeded = connection.bind()
+    except LDAPException as e:
+        print('Warning: Unable to bind as {}: {}'.format(username, e))
+    finally:
+        connection.unbind()
+        notify('bind', succeeded, time() - start)
 
-        # Verify that the user exists.
-        result = connection.search(search_base=app.config['LDAP_SEARCH_BASE'],
-                                   search_filter='(uid={})'.format(username),
-                                   attributes=['mail', 'cn'])
+    # We're authenticated! Create the actual user object.
+    return User(id=username, name=name, email=email) if succeeded else None
 
-        if not result: return None
 
-        # The user exists!
-        name = connection.response[0]['attributes']['cn'][0]
-        email = connection.response[0]['attributes']['mail'][0]
+def lookup(username):
+    """
+    Returns the distinguished name, name, and email address of a user as a
+    tuple (or None, if there's no such user). Entries are kept for
+    LDAP_CACHE_TTL seconds.
+    """
+    with _lock:
+        cached = _directory.get(username)
+
+        if cached and cached[0] > time():
+            counters['directory_hits'] += 1
+            return cached[1]
+
+        counters['directory_misses'] += 1
 
-        # Now attempt to re-bind and authenticate with the password.
-        distinguished_name = connection.response[0]['dn']
-        connection = Connection(server, user=distinguished_name,
-                                password=password.encode('iso8859-1'))
+    entry = search(username)
 
-        if not connection.bind(): return None
+    if entry is not None:
+        with _lock:
+            _directory[username] = (
+                time() + app.config.get('LDAP_CACHE_TTL', 300), entry
+            )
 
-        # We're authenticated! Create the actual user object.
-        user = User(id=username, name=name, email=email)
+    return entry
+
+
+def search(username):
+    """
+    Searches LDAP for a user, using one of the pooled anonymous connections
+    (waiting for one, if they're all in use). If the connection has gone
+    away, it's opened again (once).
+    """
+    pool = get_pool()
+    connection = pool.get()
+
+    try:
+        for attempt in range(2):
+            start = time()
+            succeeded = False
+
+            try:
+                if connection is None:
+                    connection = Connection(get_server())
+                    if not connection.bind():
+                        connection = None
+                        return None
+
+                succeeded = connection.search(
+                    search_base=app.config['LDAP_SEARCH_BASE'],
+                    search_filter='(uid={})'.format(
+                        escape_filter_chars(username)
+                    ),
+                    attributes=['mail', 'cn']
+                )
+                break
+
+            except LDAPException as e:
+                print('Warning: LDAP search failed (attempt {}): {}'
+                      .format(attempt + 1, e))
+                connection = None
+
+            finally:
+                notify('search', succeeded, time() - start)
+        else:
+            return None
+
+        if not succeeded or not connection.response:
+            return None
+
+        # The user exists!
+        response = connection.response[0]
+        return (response['dn'], response['attributes']['cn'][0],
+                response['attributes']['mail'][0])
 
     finally:
-        connection.unbind()
-        return user
+        pool.put(connection)
+
+
+def get_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = Queue()
+            for _ in range(app.config.get('LDAP_POOL_SIZE', 4)):
+                _pool.put(None)
+
+    return _pool
+
+
+def get_server():
+    global _server
+
+    if _server is None:
+        _server = Server(app.config['LDAP_URI'])
+
+    return _server
+
+
+def load_user(id):
+    """
+    Returns the user with the specified ID, attached to the current session.
+    Users are kept (detached) for USER_CACHE_TTL seconds, so most requests
+    don't need to query the DB for them; merging them back into the session
+    doesn't query it either.
+    """
+    with _lock:
+        cached = _users.get(id)
+
+        if cached and cached[0] > time():
+            counters['user_hits'] += 1
+            return db.session.merge(cached[1], load=False)
+
+        counters['user_misses'] += 1
+
+    user = User.query.get(id)
+    if user is None:
+        return None
+
+    # Keep a copy that was never in a session, so that it isn't modified (or
+    # expired) by later requests.
+    copy = User(**{attribute.key: getattr(user, attribute.key)
+                   for attribute in inspect(User).column_attrs})
+    make_transient_to_detached(copy)
+
+    with _lock:
+        _users[id] = (time() + app.config.get('USER_CACHE_TTL', 60), copy)
+
+    return user
+
+
+def forget(id):
+    """
+    Removes a user from the caches (when they log out, for example), so that
+    they're read from LDAP and the DB again.
+    """
+    with _lock:
+        _directory.pop(id, None)
+        _users.pop(id, None)
+
+
+def statistics():
+    """
+    Returns a snapshot of the cache counters, as well as the cache sizes.
+    """
+    with _lock:
+        stats = dict(counters)
+        stats['directory_entries'] = len(_directory)
+        stats['users'] = len(_users)
+
+    return stats
+
 
+def notify(kind, succeeded, elapsed):
+    for listener in listeners:
+        listener(kind, succeeded, elapsed)
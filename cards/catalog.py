@@ -0,0 +1,153 @@
+from collections import defaultdict
+from copy import deepcopy
+from threading import Lock
+from os import path
+import json
+
+from cards import app
+
+
+# Cards from the dump, indexed by lowercase name and by the Multiverse IDs of
+# their printings. Sets are indexed by name (mapping to their codes). The
+# lowercase names are also indexed by the three-character sequences in them,
+# so that partial names don't have to be compared with every card.
+_cards = None
+_multiverse_ids = {}
+_sets = {}
+_trigrams = {}
+_lock = Lock()
+
+# Whether loading the catalog from CATALOG_FILE has been attempted.
+_attempted = False
+_attempt_lock = Lock()
+
+
+def load(file_name=None):
+    """
+    Loads a DeckBrew-format JSON dump (a list of cards, exactly as returned by
+    the /mtg/cards endpoint) into memory, replacing any catalog already
+    loaded. Defaults to the file specified by CATALOG_FILE.
+    """
+    global _cards, _multiverse_ids, _sets, _trigrams, _attempted
+
+    if file_name is None:
+        file_name = app.config.get('CATALOG_FILE')
+
+    with open(file_name, 'r') as f:
+        dump = json.load(f)
+
+    cards = {}
+    multiverse_ids = {}
+    sets = {}
+    trigrams = defaultdict(set)
+
+    for card in dump:
+        name = card['name'].lower()
+        cards[name] = card
+
+        for gram in name_trigrams(name):
+            trigrams[gram].add(name)
+
+        for edition in card.get('editions', []):
+            if edition.get('multiverse_id'):
+                multiverse_ids.setdefault(
+                    edition['multiverse_id'], []
+                ).append(card)
+
+            if edition.get('set') and edition.get('set_id'):
+                sets[edition['set']] = edition['set_id']
+
+    with _lock:
+        _cards, _multiverse_ids, _sets = cards, multiverse_ids, sets
+        _trigrams = dict(trigrams)
+
+    # A catalog loaded explicitly isn't replaced by the one in CATALOG_FILE.
+    _attempted = True
+
+    print('Loaded {} cards in {} sets from {}.'
+          .format(len(cards), len(sets), file_name))
+
+
+def available():
+    """
+    Returns True if there is a local catalog, loading it from CATALOG_FILE the
+    first time this is called (if the file exists).
+    """
+    global _attempted
+
+    if not _attempted:
+        with _attempt_lock:
+            file_name = app.config.get('CATALOG_FILE')
+
+            if not _attempted and file_name and path.exists(file_name):
+                try:
+                    load(file_name)
+                except Exception as e:
+                    print('Warning: Unable to load card catalog from {}: {}'
+                          .format(file_name, e))
+
+            _attempted = True
+
+    return bool(_cards)
+
+
+def name_trigrams(name):
+    """
+    Returns the set of three-character sequences in a (lowercase) name.
+    """
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+def search(name, limit=None):
+    """
+    Returns copies of the cards whose names contain the specified name (or
+    only the card with exactly that name, if there is one), in alphabetical
+    order. Like DeckBrew, at most limit (default CATALOG_SEARCH_LIMIT) cards
+    are returned.
+    """
+    if not available():
+        return []
+
+    if limit is None:
+        limit = app.config.get('CATALOG_SEARCH_LIMIT', 100)
+
+    name = name.lower()
+
+    if name in _cards:
+        return [deepcopy(_cards[name])]
+
+    # Only names containing every sequence in the name can contain it. (Names
+    # shorter than three characters have none, so every name is checked.)
+    grams = sorted(
+        (_trigrams.get(gram, set()) for gram in name_trigrams(name)), key=len
+    )
+    candidates = set.intersection(*grams) if grams else _cards
+
+    matches = sorted(n for n in candidates if name in n)
+
+    return [deepcopy(_cards[n]) for n in matches[:limit]]
+
+
+def by_multiverse_id(multiverse_id):
+    """
+    Returns copies of the cards printed with the specified Multiverse ID (two
+    of them, for split cards).
+    """
+    if not available():
+        return []
+
+    return deepcopy(_multiverse_ids.get(multiverse_id, []))
+
+
+def set_code(name):
+    """
+    Returns the code of the set with the specified name, if it's known.
+    """
+    return _sets.get(name) if available() else None
+
+
+def names():
+    """
+    Returns the names of every card in the catalog.
+    """
+    return [c['name'] for c in _cards.values()] if available() else []
@@ -1,9 +1,16 @@
 from collections import OrderedDict
-import re, csv
-
-from cards import db, deckbrew
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from io import StringIO
+from sqlalchemy import case, func, text
+from sqlalchemy.orm import contains_eager, joinedload
+import re, csv, json
+
+from cards import app, db, fuzzy, models, providers, stats
 from cards.models import (
-    User, Set, Card, Edition, set_to_byte, COLOR_MASK, TYPE_MASK
+    User, Set, Card, Edition, Price, set_to_byte, COLOR_MASK, TYPE_MASK
 )
 
 
@@ -28,27 +35,52 @@ CSV_COLUMNS = [
     'uncertain'
 ]
 
+# The names of all sets (see set_names), and the version of the list cached.
+_set_version = 0
+_set_names = (None, [])
+_set_lock = Lock()
+
 
 def fetch(
-    user, filters=None, group=None, sort=None, page_size=None, page_number=1
+    user, filters=None, group=None, sort=None, page_size=None, page_number=1,
+    cursor=None
 ):
     """
     Returns all of the user's cards matching the filters provided. If the
     optional group argument is specified, an OrderedDict grouping the results
     by the specified value will be returned instead of a list.
 
+    Also returns a dict describing the page of results: the total number of
+    matching editions ("total"), the number of pages ("pages"), and the number
+    of the page returned ("page"). When using the default sort order, it also
+    contains an opaque cursor for the following page ("next"), or None if
+    this is the last page.
+
     filters: dict containing what column to filter and a list of valid values
     group: string to group results by "set", "color", or "type" (default None)
     sort: list of attributes to sort by (default release date and collector #)
+    page_size: number of editions per page (default None, for no pagination)
+    page_number: which page of results to return, starting at 1
+    cursor: the "next" cursor of the previous page; if provided, the page is
+            found by seeking past that edition instead of counting rows with
+            page_number (which gets slower the deeper you go)
     """
     if filters is None:
         filters = {}
 
-    if sort is None:
-        sort = [Set.release_date.desc(), Edition.collector_number, Card.name]
-
-    # Define query and filters.
-    query = user.editions.join(Card).join(Set)
+    # Keyset pagination needs a total ordering, so the edition ID breaks ties.
+    keyset = sort is None
+    if keyset:
+        sort = [Set.release_date.desc(), Edition.collector_number, Card.name,
+                Edition.id]
+    elif cursor:
+        raise Exception('Cursors can only be used with the default sort.')
+
+    # Define query and filters. The card and set of each edition are loaded by
+    # the same query that fetches the editions.
+    query = user.editions.join(Card).join(Set).options(
+        contains_eager(Edition.card), contains_eager(Edition.set)
+    )
     where = []
 
     if filters.get('color'):
@@ -72,6 +104,10 @@ def fetch(
         c = Card.type_byte.op('&')(set_to_byte(TYPE_MASK, filters['type']))
         where.append(c)
 
+    if filters.get('card'):
+        # Only return editions of the cards listed (by ID).
+        where.append(Card.id.in_(filters['card']))
+
     if filters.get('set'):
         if isinstance(filters['set'], str):
             filters['set'] = [filters['set']]
@@ -83,20 +119,43 @@ def fetch(
         # Only return editions where you have at least one copy of the card.
         where.append(Edition.have >= 1)
 
+    if 'Wanted' in filters.get('collection', []):
+        # Only return cards where you need at least one of the cards.
+        where.append(Card.need >= 1)
+
     # Apply filters and ordering to query.
     query = query.filter(*where).order_by(*sort)
 
-    # Apply pagination functions.
+    # Apply pagination functions. Filtering is done entirely in the query, so
+    # every page except the last is full.
     if page_size:
-        query = query.limit(page_size).offset(page_size * (page_number - 1))
+        total = query.order_by(None).count()
+
+        if cursor:
+            query = query.filter(after(decode_cursor(cursor)))
+        else:
+            query = query.offset(page_size * (page_number - 1))
+
+        query = query.limit(page_size)
 
     # Execute query.
     result = query.all()
 
-    # Finish filtering by cards you need (difficult to do in the query itself).
-    if 'Wanted' in filters.get('collection', []):
-        # Only return cards where you need at least one of the cards.
-        result = filter(lambda e: e.card.need() >= 1, result)
+    if not page_size:
+        total = len(result)
+
+    page = {
+        'total': total,
+        'pages': -(-total // page_size) if page_size else 1,
+        'page': page_number if page_size else 1,
+        'next': None
+    }
+
+    # A full page may also be the last one (if the total is a multiple of the
+    # page size).
+    if (keyset and page_size and len(result) == page_size and
+            page_number < page['pages']):
+        page['next'] = encode_cursor(result[-1])
 
     # Group.
     if group:
@@ -124,16 +183,276 @@ def fetch(
     else:
         cards = result
 
-    return cards
+    return cards, page
+
+
+def search(user, query, page_size=None, page_number=1):
+    """
+    Returns the user's editions of the cards whose names, type lines, or rules
+    text match the query, grouped by card (in an OrderedDict, best matches
+    first). Each word in the query matches words that start with it. Like
+    fetch, this also returns a dict describing the page of results, although
+    pages are counted in cards rather than editions.
+    """
+    words = re.findall(r'\w+', query)
+    page = {'total': 0, 'pages': 1, 'page': page_number, 'next': None}
+
+    if not words:
+        return OrderedDict(), page
+
+    if models.full_text_search:
+        # Quoting each word stops FTS5 from interpreting it as an operator.
+        match = ' '.join('"{}"*'.format(w) for w in words)
+        matches = """
+            FROM card_search JOIN card ON card.id = card_search.rowid
+            WHERE card_search MATCH :match AND card.user_id = :user
+        """
+        parameters = {'match': match, 'user': user.id}
+
+        ids = 'SELECT card.id ' + matches + ' ORDER BY card_search.rank'
+        if page_size:
+            ids += ' LIMIT :limit OFFSET :offset'
+            parameters['limit'] = page_size
+            parameters['offset'] = page_size * (page_number - 1)
+
+        ids = [id for id, in db.session.execute(text(ids), parameters)]
+        total = db.session.execute(
+            text('SELECT count(*) ' + matches), parameters
+        ).scalar()
+
+    else:
+        # Without FTS5, fall back on (much slower) pattern matching.
+        query = user.cards.filter(*[
+            Card.name.ilike('%{}%'.format(w)) |
+            Card.type_line.ilike('%{}%'.format(w)) |
+            Card.text.ilike('%{}%'.format(w))
+            for w in words
+        ])
+        total = query.count()
+
+        query = query.order_by(Card.name)
+        if page_size:
+            query = query.limit(page_size)
+            query = query.offset(page_size * (page_number - 1))
+
+        ids = [c.id for c in query]
+
+    page['total'] = total
+    if page_size:
+        page['pages'] = max(-(-total // page_size), 1)
+
+    editions, _ = fetch(user, {'card': ids}) if ids else ([], None)
+
+    by_card = OrderedDict((id, []) for id in ids)
+    for edition in editions:
+        by_card[edition.card_id].append(edition)
+
+    cards = OrderedDict(
+        (e[0].card.name, e) for e in by_card.values() if e
+    )
+
+    return cards, page
+
+
+def encode_cursor(edition):
+    """
+    Encodes the default sort key of an edition as an opaque, URL-safe string.
+    """
+    release_date = edition.set.release_date
+    key = [
+        release_date.isoformat() if release_date else None,
+        edition.collector_number,
+        edition.card.name,
+        edition.id
+    ]
+
+    return urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor produced by encode_cursor back into a sort key. Raises a
+    ValueError if the cursor is invalid.
+    """
+    try:
+        release_date, number, name, id = json.loads(
+            urlsafe_b64decode(cursor.encode()).decode()
+        )
+        if release_date:
+            release_date = datetime.strptime(release_date, '%Y-%m-%d').date()
+    except Exception:
+        raise ValueError('Invalid cursor "{}".'.format(cursor))
+
+    return release_date, number, name, id
+
+
+def after(key):
+    """
+    Builds a condition matching the editions that come after the specified
+    sort key in the default order (release date descending, then collector
+    number, card name, and edition ID ascending).
+    """
+    release_date, number, name, id = key
+
+    condition = Edition.id > id
+    condition = follows(Card.name, name, condition)
+    condition = follows(Edition.collector_number, number, condition)
+    condition = follows(Set.release_date, release_date, condition, True)
+
+    return condition
+
+
+def follows(column, value, tie, descending=False):
+    """
+    Builds a condition matching rows that sort after value in the column, or
+    that are equal to it and match the tie-breaking condition. SQLite sorts
+    NULL before everything else, so it is treated as the smallest value.
+    """
+    if value is None:
+        if descending:
+            return column.is_(None) & tie
+        return column.isnot(None) | (column.is_(None) & tie)
+
+    if descending:
+        return (column < value) | column.is_(None) | ((column == value) & tie)
+    return (column > value) | ((column == value) & tie)
 
 
 def add_card(
-    user, name, want=None, have=dict(), important=None, uncertain=None
+    user, name, want=None, have=None, important=None, uncertain=None
 ):
     """
     Adds a card to the user's database.
     """
-    card = deckbrew.find_card(name)
+    store_card(user, resolve_card(name), want, have, important, uncertain)
+    commit()
+
+
+def increment(user, changes):
+    """
+    Changes the number of copies owned of many editions at once, without
+    looking anything up. changes is a list of (card name, set name, delta)
+    tuples; counts never go below zero. The editions (and the other editions
+    of their cards, for the statistics) are read with a single SELECT, then
+    each count is changed with an UPDATE that adds to it in SQL, and all of it
+    is committed together (if any count actually changed). If any edition
+    isn't in the collection, nothing is changed. Returns a dictionary mapping
+    each (card name, set name) to its new count.
+    """
+    deltas = OrderedDict()
+    for name, set_name, delta in changes:
+        deltas[(name, set_name)] = deltas.get((name, set_name), 0) + delta
+
+    if not deltas:
+        return OrderedDict()
+
+    rows = db.session.query(
+        Edition.id, Edition.card_id, Edition.have, Edition.rarity, Card.name,
+        Card.want, Card.color_byte, Card.type_byte, Set.name.label('set_name'),
+        Set.release_date, Price.price
+    ).join(Card, Edition.card_id == Card.id).join(
+        Set, Edition.set_id == Set.id
+    ).outerjoin(Price, Price.edition_id == Edition.id).filter(
+        Edition.user_id == user.id,
+        Card.name.in_({name for name, set_name in deltas})
+    ).all()
+
+    found = {(row.name, row.set_name): row for row in rows}
+    missing = [key for key in deltas if key not in found]
+    if missing:
+        raise Exception('Not in the collection: {}.'.format(', '.join(
+            '{} ({})'.format(name, set_name) for name, set_name in missing
+        )))
+
+    # What stats.tally needs: each card's want, color, and type, and the have,
+    # set name, release date, rarity, and price of each of its editions (by
+    # edition ID, as lists so the counts can be changed).
+    cards = {}
+    editions = {}
+    for row in rows:
+        cards.setdefault(row.card_id, (
+            row.want, models.color_name(row.color_byte),
+            models.type_name(row.type_byte)
+        ))
+        editions.setdefault(row.card_id, OrderedDict())[row.id] = [
+            row.have or 0, row.set_name, row.release_date, row.rarity,
+            row.price
+        ]
+
+    before = {
+        card_id: stats.tally(*cards[card_id], list(e.values()))
+        for card_id, e in editions.items()
+    }
+
+    counts = OrderedDict()
+    changed = set()
+    for (name, set_name), delta in deltas.items():
+        row = found[(name, set_name)]
+        edition = editions[row.card_id][row.id]
+        old = edition[0]
+        new = max(old + delta, 0)
+
+        if new != old:
+            print('Updating number of {} ({}) in collection from {} to {}.'
+                  .format(name, set_name, old, new))
+
+            # Clamped in SQL too, in case the count has changed since it was
+            # read.
+            have = func.coalesce(Edition.have, 0) + (new - old)
+            db.session.query(Edition).filter(Edition.id == row.id).update(
+                {Edition.have: case([(have < 0, 0)], else_=have)},
+                synchronize_session=False
+            )
+
+            # Without the triggers, the card's total has to be changed here
+            # (the ORM events don't see bulk UPDATEs).
+            if not models.have_triggers:
+                db.session.query(Card).filter(Card.id == row.card_id).update(
+                    {Card.have_total: Card.have_total + (new - old)},
+                    synchronize_session=False
+                )
+
+            edition[0] = new
+            changed.add(row.card_id)
+
+        counts[(name, set_name)] = new
+
+    # Nothing to write (so the collection's version shouldn't change).
+    if not changed:
+        return counts
+
+    for card_id in changed:
+        stats.stage(user.id, before[card_id], stats.tally(
+            *cards[card_id], list(editions[card_id].values())
+        ))
+
+    touch(user)
+    commit()
+
+    return counts
+
+
+def find_card(name):
+    """
+    Returns the names of the cards matching the specified name (correcting
+    typos against the card names already known, if possible).
+    """
+    return [c.get('name') for c in providers.get().find_card(name)]
+
+
+def suggest_cards(name, limit=5):
+    """
+    Returns the names of the known cards most similar to the specified name.
+    """
+    return [n for n, similarity in fuzzy.candidates(name, limit)]
+
+
+def resolve_card(name):
+    """
+    Looks up the single card matching the specified name, raising an exception
+    if there are no matches or several.
+    """
+    card = providers.get().find_card(name)
 
     if not card:
         raise Exception('No cards found with the name "{}".'.format(name))
@@ -145,19 +464,70 @@ def add_card(
 
     # Colors and card types are stored returned by DeckBrew in lowercase. They
     # need to be capitalized for dictionary mapping lookups.
-    card['colors'] = map(lambda x: x.capitalize(), card.get('colors', []))
-    card['types'] = map(lambda x: x.capitalize(), card.get('types', []))
+    card['colors'] = [x.capitalize() for x in card.get('colors', [])]
+    card['types'] = [x.capitalize() for x in card.get('types', [])]
+
+    return card
+
+
+def store_card(
+    user, card, want=None, have=None, important=None, uncertain=None,
+    sets=None, known=None
+):
+    """
+    Adds a card found by resolve_card to the user's database (or updates it,
+    if it's already there) without committing.
+
+    have: dict mapping set names to the number of copies you have from each
+    sets: dict of Set objects by name, shared by calls that add many cards at
+          once so that each set is only looked up once (default None)
+    known: the (Card, editions) tuple returned for this card by load_cards,
+           if it has already been looked up (default None)
+    """
+    have = dict(have) if have else {}
+
+    if sets is None:
+        sets = {}
 
     # Identify all printings of the card.
-    editions = set()
-    for edition in card.get('editions', []):
-        # Some set names are remarkably dumb and/or contain non-ASCII chars.
-        # At least one From the Vault is listed in DeckBrew with a date, too.
-        edition['set'] = re.sub(r'Magic: The Gathering[^A-Za-z]*', '',
-                                edition.get('set'))
-        edition['set'] = re.sub(r'(From the Vault:( \w+)+?) \(\d{4}\)', r'\1',
-                                edition.get('set'))
+    printings = list(card_printings(card))
+
+    # Look up every Set and Edition this card could need up front (one query
+    # each), rather than once per printing.
+    set_names = {
+        e['set'] for e in printings if e.get('set') and e.get('set_id')
+    }
+    load_sets(user, set_names, sets)
+
+    if known is None:
+        known = load_cards(user, [card['name']])[card['name']]
+
+    c, existing = known
+
+    # Note what the card adds to the collection statistics before it changes.
+    before = stats.contributions(c, list(existing.values()))
+
+    # Build any Set objects that don't exist yet, all at once.
+    new_sets = {}
+    for edition in printings:
+        if edition['set'] in set_names and edition['set'] not in sets:
+            new_sets.setdefault(edition['set'], edition['set_id'])
 
+    if new_sets:
+        dates = providers.get().release_dates(new_sets.keys())
+
+        for name, code in new_sets.items():
+            print('Adding set {}.'.format(name))
+            sets[name] = Set(
+                code=code, name=name, release_date=dates.get(name), user=user
+            )
+
+        # Cached lists of sets are refreshed once this is committed.
+        db.session.info['sets_changed'] = True
+
+    editions = []
+    seen = set()
+    for edition in printings:
         # Some sets have multiple "editions" of the same card (Arabian Nights
         # had two printings that were essentially identical, while some older
         # sets like Fallen Empires and Alliances had alternate art for the
@@ -165,36 +535,26 @@ def add_card(
         # dealt with mandating a unique constraint on multiverse_id in a given
         # set (instead of name), but it's easiest to just roll all of those
         # editions into one. For my purposes, it's not worth the trouble.
-        if edition['set'] in [e.set.name for e in editions]:
+        if edition['set'] in seen:
             print(
                 'Skipping additional printings of {} from {}.'
                 .format(card['name'], edition['set'])
             )
             continue
 
-        # First, find and/or build the necessary Set objects.
-        if not (edition.get('set') and edition.get('set_id')):
+        # First, find the necessary Set object.
+        if edition['set'] not in set_names:
             print(
                 'Warning: Set information for this edition is incomplete: '
                 '{} ({})'.format(edition.get('set'), edition.get('set_id'))
             )
             continue
 
-        s = user.sets.filter(Set.name == edition['set']).scalar()
-
-        if not s:
-            # Build the necessary Set object.
-            print('Adding set {}.'.format(edition['set']))
-            s = Set(
-                code=edition['set_id'],
-                name=edition['set'],
-                release_date=deckbrew.release_date(edition['set'])
-            )
+        seen.add(edition['set'])
+        s = sets[edition['set']]
 
         # Second, find and/or build the necessary Edition objects.
-        e = user.editions.join(Set).join(Card).filter(
-            (Set.name == edition['set']) & (Card.name == card['name'])
-        ).scalar()
+        e = existing.get(edition['set'])
 
         in_collection = have.pop(edition['set'], None)
         if e:
@@ -217,14 +577,13 @@ def add_card(
                 collector_number=edition.get('number'),
                 rarity=rarity(edition.get('rarity')),
                 have=in_collection if in_collection else 0,
-                set=s   # Associate the Set object with this Edition.
+                set=s,  # Associate the Set object with this Edition.
+                user=user
             )
 
-        editions.add(e)
-
-    # Finally, find and/or build the Card object.
-    c = user.cards.filter(Card.name == card['name']).scalar()
+        editions.append(e)
 
+    # Finally, update or build the Card object.
     if c:
         # Update fields in the Card object if necessary.
         if (want is not None) and (c.want != want):
@@ -251,8 +610,18 @@ def add_card(
             )
             c.uncertain = uncertain
 
-        # Attach the Edition objects to the Card object.
-        c.editions = editions
+        # Keep the text used by the search index up to date.
+        c.type_line = type_line(card)
+        c.text = card.get('text')
+
+        # Attach the Edition objects to the Card object, and remove those it
+        # no longer has. (Assigning to c.editions would load them all again.)
+        for e in editions:
+            e.card = c
+
+        for e in existing.values():
+            if e not in editions:
+                db.session.delete(e)
         # If we previously had editions that don't exist in DeckBrew now...?
         # TODO: What does the above comment mean?
         # Probably means an edition was added manually before the edition was
@@ -261,15 +630,18 @@ def add_card(
     else:
         # Build the necessary Card object.
         print('Adding card {}.'.format(card['name']))
+        fuzzy.add([card['name']])
 
         c = Card(
             name=card['name'],
             color_byte=set_to_byte(COLOR_MASK, set(card.get('colors', []))),
             type_byte=set_to_byte(TYPE_MASK, set(card.get('types', []))),
+            type_line=type_line(card),
+            text=card.get('text'),
             cost=card.get('cost'),
             power=card.get('power'),
             toughness=card.get('toughness'),
-            want=want,
+            want=want or 0,
             important=bool(important),   # None and False are distinct only if
             uncertain=bool(uncertain),   # the card already exists.
             editions=editions
@@ -286,10 +658,101 @@ def add_card(
             'the printings could not be found on DeckBrew: {}'.format(have)
         )
 
-    # Add and commit to DB.
+    # Add to DB (cards that were already there belong to the user already).
+    # The statistics are brought up to date when this is committed.
+    if c.id is None:
+        user.cards.append(c)
+
+    stats.stage(user.id, before, stats.contributions(c, editions))
+    touch(user)
+
+    return c
+
+
+def card_printings(card):
+    """
+    Yields the printings of a card found by resolve_card, with their set names
+    cleaned up (in place, so this can safely be done more than once).
+    """
+    for edition in card.get('editions', []):
+        # Some set names are remarkably dumb and/or contain non-ASCII chars.
+        # At least one From the Vault is listed in DeckBrew with a date, too.
+        edition['set'] = re.sub(r'Magic: The Gathering[^A-Za-z]*', '',
+                                edition.get('set'))
+        edition['set'] = re.sub(r'(From the Vault:( \w+)+?) \(\d{4}\)', r'\1',
+                                edition.get('set'))
+        yield edition
+
+
+def load_sets(user, names, sets):
+    """
+    Adds the user's sets with the specified names that aren't in sets (a dict
+    of Set objects by name) yet to it, with a single query.
+    """
+    missing = [name for name in names if name not in sets]
+    if missing:
+        for s in user.sets.filter(Set.name.in_(missing)):
+            sets[s.name] = s
+
+
+def load_cards(user, names):
+    """
+    Looks up the user's cards with the specified names, and all of their
+    editions (with their sets and prices), with one query each. Returns a
+    dict mapping each name to a (Card, dict of Editions by set name) tuple;
+    cards that aren't in the collection map to (None, {}).
+    """
+    found = {name: (None, {}) for name in names}
+    if not found:
+        return found
+
+    for c in user.cards.filter(Card.name.in_(found)):
+        found[c.name] = (c, {})
+
+    for e in user.editions.join(Set).join(Card).filter(
+        Card.name.in_(found)
+    ).options(
+        contains_eager(Edition.set), contains_eager(Edition.card),
+        joinedload(Edition.cached_price)
+    ):
+        found[e.card.name][1][e.set.name] = e
+
+    return found
+
+
+def type_line(card):
+    """
+    Builds the type line of a card found by resolve_card (e.g., "Legendary
+    Creature \u2014 Goblin Shaman").
+    """
+    types = [t.capitalize() for t in card.get('supertypes', [])]
+    types += card.get('types', [])
+    subtypes = [t.capitalize() for t in card.get('subtypes', [])]
+
+    line = ' '.join(types)
+    if subtypes:
+        line += ' \u2014 ' + ' '.join(subtypes)
+
+    return line
+
+
+def commit():
+    """
+    Commits the session (along with any changes to statistics staged since
+    the last commit), rolling back if it fails.
+    """
+    sets_changed = db.session.info.pop('sets_changed', False)
+    touched = db.session.info.pop('touched', set())
+
     try:
-        user.cards.add(c)
-        #db.session.add(c)
+        stats.apply_staged()
+
+        if touched:
+            # Incremented in SQL, so that concurrent writes aren't lost.
+            db.session.query(User).filter(User.id.in_(touched)).update(
+                {User.version: User.version + 1}, synchronize_session=False
+            )
+
         db.session.commit()
     except Exception as e:
         print('Error: Unable to issue database commit: {}\nRolling back...'
@@ -297,6 +760,86 @@ def add_card(
         db.session.rollback()
         raise e
 
+    if sets_changed:
+        invalidate_set_names()
+
+
+def rollback():
+    """
+    Discards everything added to the session since the last commit.
+    """
+    db.session.info.pop('sets_changed', None)
+    db.session.info.pop('touched', None)
+    db.session.info.pop('statistics', None)
+    db.session.rollback()
+
+
+def verify_have_totals(user=None, fix=False):
+    """
+    Checks that the have_total of each card (or each of the user's cards)
+    matches the sum of its editions, returning (name, have_total, actual)
+    tuples for those that don't. If fix is True and any have drifted, every
+    card's total is recomputed (without committing).
+    """
+    actual = db.session.query(
+        Edition.card_id, func.sum(Edition.have).label('have')
+    ).group_by(Edition.card_id).subquery()
+
+    query = db.session.query(
+        Card.name, Card.have_total, func.coalesce(actual.c.have, 0)
+    ).outerjoin(actual, actual.c.card_id == Card.id).filter(
+        Card.have_total != func.coalesce(actual.c.have, 0)
+    )
+
+    if user:
+        query = query.filter(Card.user_id == user.id)
+
+    drift = query.order_by(Card.name).all()
+
+    if drift and fix:
+        db.session.execute(text(models.HAVE_TOTALS))
+
+    return drift
+
+
+def touch(user):
+    """
+    Marks the user's collection as changed. The collection's version number
+    (used by the API for ETags) is incremented when the session is committed.
+    """
+    db.session.info.setdefault('touched', set()).add(user.id)
+
+
+def set_names():
+    """
+    Returns the names of all sets, most recently released first. The list is
+    cached in memory until a new set is committed.
+    """
+    global _set_names
+
+    version, names = _set_names
+
+    if version != _set_version:
+        version = _set_version
+        names = [
+            name for name, in db.session.query(Set.name).order_by(
+                Set.release_date.desc(), Set.name
+            )
+        ]
+        _set_names = (version, names)
+
+    return names
+
+
+def invalidate_set_names():
+    """
+    Bumps the version of the set list, so that set_names queries it again.
+    """
+    global _set_version
+
+    with _set_lock:
+        _set_version += 1
+
 
 # TODO: If a set isn't in Deckbrew, create it anyway. We won't have all infor
 # for either the edition or the set that way, but...
@@ -305,51 +848,199 @@ def add_card(
 
 
 
-def import_csv(user, file_name):
+def import_csv(
+    user, file_name, chunk_size=None, concurrency=None, progress=None
+):
     """
-    Takes a file name (or open file?) and imports it using multiple calls to the
-    add_card function.
+    Imports a collection from a CSV file. The file is read in a single pass,
+    grouping its rows by card name. The cards are then looked up and added in
+    chunks of chunk_size (default IMPORT_CHUNK_SIZE), with one commit each.
+
+    Cards are looked up by a pool of concurrency threads (default
+    IMPORT_CONCURRENCY), which keeps working on later chunks while earlier
+    ones are being written to the database (from this thread only).
+
+    Rows and cards that can't be imported are skipped rather than aborting the
+    whole import. Returns a list of (row number or card name, error) tuples.
+
+    progress: function called with the number of cards imported so far and
+              the total number of cards after each chunk (default None)
     """
+    if chunk_size is None:
+        chunk_size = app.config.get('IMPORT_CHUNK_SIZE', 100)
+
+    cards = OrderedDict()
+    errors = []
+
     with open(file_name, 'r') as csv_file:
         reader = csv.reader(csv_file)
 
         # Skip the header.
         next(reader, None)
 
-        # Convert each row from a list to a dictionary for easier indexing.
-        rows = [
-            {column: r[index] for index, column in enumerate(CSV_COLUMNS)}
-            for r in reader
-        ]
+        for number, r in enumerate(reader, 2):
+            row = dict(zip(CSV_COLUMNS, r))
+
+            try:
+                name = row['name']
+                want = int(row['want'] or 0)
+                have = int(row['have'] or 0)
+            except (KeyError, ValueError) as e:
+                errors.append((number, 'Invalid row: {}'.format(e)))
+                continue
+
+            if not name:
+                errors.append((number, 'Invalid row: No card name.'))
+                continue
+
+            card = cards.setdefault(name, {
+                'want': 0, 'have': {}, 'important': False, 'uncertain': False
+            })
+            card['want'] += want
+            card['have'][row['set']] = have
+            card['important'] = card['important'] or bool(row['important'])
+            card['uncertain'] = card['uncertain'] or bool(row.get('uncertain'))
+
+    if concurrency is None:
+        concurrency = app.config.get('IMPORT_CONCURRENCY', 8)
+
+    names = list(cards)
+    sets = {}
+
+    # Make sure the provider (with its release dates) and the index of known
+    # card names are ready before any lookups need them.
+    providers.get().release_dates([])
+    fuzzy.build()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        lookups = [pool.submit(resolve_card, name) for name in names]
+
+        for start in range(0, len(names), chunk_size):
+            chunk = []
+
+            for name, lookup in zip(
+                names[start:start + chunk_size],
+                lookups[start:start + chunk_size]
+            ):
+                if lookup.exception():
+                    errors.append((name, str(lookup.exception())))
+                else:
+                    chunk.append((name, lookup.result(), cards[name]))
 
-    cards = {r['name'] for r in rows}
+            import_chunk(user, chunk, sets, errors)
 
-    for card in cards:
-        want = sum([int(r['want']) for r in rows if r['name'] == card])
-        have = {r['set']: int(r['have']) for r in rows if r['name'] == card}
-        important = any([r['important'] for r in rows if r['name'] == card])
-        uncertain = any([r['uncertain'] for r in rows if r['name'] == card])
+            done = min(start + chunk_size, len(names))
+            print('Imported {} of {} cards.'.format(done, len(names)))
+            if progress:
+                progress(done, len(names))
 
-        print('Importing {} {} {} {} {}'
-              .format(card, want, have, important, uncertain))
-        add_card(user, card, want, have, important, uncertain)
+    if errors:
+        print('Warning: {} rows or cards could not be imported.'
+              .format(len(errors)))
 
+    return errors
 
-def export_csv(f):
+
+def import_chunk(user, chunk, sets, errors):
     """
-    Exports the entire DB to a CSV file for easy backup.
+    Adds a list of (name, card, values) tuples to the user's database in a
+    single commit. The cards, editions, and sets already in the collection are
+    looked up for the whole chunk at once. If a card can't be added, the chunk
+    is rolled back and retried without it.
     """
+    while chunk:
+        failed = None
+
+        try:
+            load_sets(user, {
+                e['set'] for name, card, values in chunk
+                for e in card_printings(card) if e.get('set')
+            }, sets)
+            known = load_cards(
+                user, {card['name'] for name, card, values in chunk}
+            )
+
+            for name, card, values in chunk:
+                failed = name
+
+                # If another row resolves to the same card (under a different
+                # name), it's looked up again, so it finds this one.
+                store_card(
+                    user, card, values['want'], values['have'],
+                    values['important'], values['uncertain'], sets,
+                    known.pop(card['name'], None)
+                )
+
+            failed = None
+            commit()
+            return
 
-    # Should assign "want" values such that they fit with the editions and all
-    # add up to the total want value. (Probably just assign it to the latest
-    # printing, then set all others to zero? Or something more complicated.)
+        except Exception as e:
+            rollback()
 
+            # Anything created in this chunk is gone after the rollback.
+            sets.clear()
 
-    # Test importing an exported file. Should be no errors!
+            if failed is None:
+                errors.extend((name, str(e)) for name, card, values in chunk)
+                return
 
-    # TODO: Write this.
+            errors.append((failed, str(e)))
+            chunk = [c for c in chunk if c[0] != failed]
+
+
+def export_csv(user, batch_size=500):
+    """
+    Exports the user's collection as CSV (in the format read by import_csv),
+    yielding one line at a time so that it can be streamed. Editions are
+    loaded from the DB batch_size at a time.
+
+    Only editions that you have, or that carry a card's "want" value, are
+    exported. The whole "want" value is assigned to the latest printing of
+    each card, so that it adds up correctly when imported.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    def line(row):
+        writer.writerow(row)
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    yield line(CSV_COLUMNS)
+
+    query = user.editions.join(Card).join(Set).outerjoin(Price).options(
+        contains_eager(Edition.card), contains_eager(Edition.set),
+        contains_eager(Edition.cached_price)
+    ).order_by(
+        Card.name, Set.release_date.desc(), Edition.id
+    ).yield_per(batch_size)
+
+    card = None
+    for edition in query:
+        latest = edition.card is not card
+        card = edition.card
+        want = card.want if latest else 0
+
+        if not (edition.have or want):
+            continue
 
-    pass
+        release_date = edition.set.release_date
+        price = edition.cached_price
+
+        yield line([
+            'Y' if card.important else '',
+            release_date.isoformat() if release_date else '',
+            edition.set.name,
+            card.name,
+            price.price if price and price.price else '',
+            want,
+            edition.have,
+            card.need if latest else 0,
+            'Y' if card.uncertain else ''
+        ])
 
 
 def rarity(word):
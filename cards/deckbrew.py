@@ -1,38 +1,199 @@
-from datetime import datetime, date
+from datetime import datetime
 from dateutil.parser import parse
-import re, requests
+from threading import Lock
+from time import time, sleep
+from os import path
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import re, json, requests
+
+from cards import app, catalog, fuzzy
+from cards.models import ALTERNATE_NAMES
 
 
 BASE_REQUEST = 'https://api.deckbrew.com/mtg/cards'
+WIKIPEDIA_SETS = (
+    'http://en.wikipedia.org/wiki/List_of_Magic:_The_Gathering_sets'
+)
+
+# Release dates by set name, along with the time they were fetched.
+_release_dates = None
+_release_lock = Lock()
+
+# When the release dates last failed to download.
+_release_failed = None
+
+# The HTTP client shared by every request (see get_client).
+_client = None
+_client_lock = Lock()
+
+
+class Client:
+    """
+    Sends GET requests over a pool of keep-alive connections, with timeouts,
+    retries (backing off exponentially), and rate limiting. Keeps track of how
+    many requests were made and how long they took.
+    """
+    def __init__(
+        self, timeout=10, retries=3, backoff=0.5, pool_size=10, rate_limit=None
+    ):
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+
+        # Retry connection problems and server errors, but not client errors.
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries, backoff_factor=backoff, raise_on_status=False,
+                status_forcelist=[500, 502, 503, 504]
+            )
+        )
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Functions called with the URL, status code (None for errors) and
+        # duration in seconds of every request.
+        self.listeners = []
+
+        self.counters = {'requests': 0, 'errors': 0, 'seconds': 0.0}
+        self._lock = Lock()
+        self._next_request = 0
 
+    def get(self, url):
+        """
+        Sends a GET request, raising requests.RequestException if it fails.
+        """
+        self.throttle()
 
-def find_card(name):
+        start = time()
+        status = None
+
+        try:
+            r = self.session.get(url, timeout=self.timeout)
+            status = r.status_code
+            return r
+
+        finally:
+            elapsed = time() - start
+
+            with self._lock:
+                self.counters['requests'] += 1
+                self.counters['seconds'] += elapsed
+                if status is None:
+                    self.counters['errors'] += 1
+
+            for listener in self.listeners:
+                listener(url, status, elapsed)
+
+    def throttle(self):
+        """
+        Blocks until another request can be sent without exceeding rate_limit
+        requests per second (across all threads).
+        """
+        if not self.rate_limit:
+            return
+
+        with self._lock:
+            now = time()
+            wait = self._next_request - now
+            self._next_request = max(now, self._next_request)
+            self._next_request += 1 / self.rate_limit
+
+        if wait > 0:
+            sleep(wait)
+
+    def statistics(self):
+        """
+        Returns a snapshot of the number of requests made, how many failed,
+        and how long they took in total.
+        """
+        with self._lock:
+            return dict(self.counters)
+
+
+def get_client():
     """
-    Searches DeckBrew for cards that match the specified name. If there is an
-    exact match among the cards (e.g., the search was for "Shock", which
-    returns a bunch of results as well as that specific card) return ONLY the
-    exact match. If there's no exact match, return all of them.
+    Returns the HTTP client used for all requests, building one configured by
+    the DECKBREW_* settings the first time this is called.
+    """
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = Client(
+                timeout=app.config.get('DECKBREW_TIMEOUT', 10),
+                retries=app.config.get('DECKBREW_RETRIES', 3),
+                backoff=app.config.get('DECKBREW_BACKOFF', 0.5),
+                pool_size=app.config.get('DECKBREW_POOL_SIZE', 10),
+                rate_limit=app.config.get('DECKBREW_RATE_LIMIT')
+            )
+
+        return _client
+
+
+def set_client(client):
+    """
+    Replaces the HTTP client used for all requests. Any object with a get
+    method that takes a URL and returns something resembling a requests
+    Response (with status_code, text, and json) will do, such as a fake that
+    serves canned responses in tests.
+    """
+    global _client
+
+    with _client_lock:
+        _client = client
+
+
+def find_card(name, search_cards=None, find_printing=None):
+    """
+    Searches the local catalog (or DeckBrew, if the catalog has no matches)
+    for cards that match the specified name. If there is an exact match among
+    the cards (e.g., the search was for "Shock", which returns a bunch of
+    results as well as that specific card) return ONLY the exact match. If
+    there's no exact match, return all of them.
+
+    Cards are found with search and printing, unless other functions are
+    given (as they are by the local provider, which never uses DeckBrew).
     """
     cards = []
+    search_cards = search_cards or search
+    find_printing = find_printing or printing
+
+    def lookup(name):
+        name = name.lower().replace('aether', '\xe6ther')
+
+        # To handle split cards, look up one side, get the multiverse ID, look
+        # up all cards with that multiverse ID (which is for a specific
+        # printing), and construct a name with the two "sides" of the card
+        # that show up (first the "a" side then the "b" side). This is
+        # basically the equivalent of searching "Ice // Partridge" and getting
+        # "Fire // Ice", but whatever.
 
-    name = name.lower().replace('aether', '\xe6ther')
+        # Check for split card syntax ("Fire // Ice") and remove it.
+        split = [i.strip() for i in name.split('//')]
+        if len(split) > 1:
+            name = split[0]
 
-    # To handle split cards, look up one side, get the multiverse ID, look up
-    # all cards with that multiverse ID (which is for a specific printing), and
-    # construct a name with the two "sides" of the card that show up (first the
-    # "a" side then the "b" side). This is basically the equivalent of
-    # searching "Ice // Partridge" and getting "Fire // Ice", but whatever.
+        return name, search_cards(name)
 
-    # Check for split card syntax ("Fire // Ice") and remove it.
-    split = [i.strip() for i in name.split('//')]
-    if len(split) > 1:
-        name = split[0]
+    # A name that only differs from one we already know in case, accents, or
+    # punctuation ("Lim-Dul's Vault", "fire//ice") is corrected before it's
+    # looked up, so that it doesn't cost a failed search.
+    original = fuzzy.exact(name) or name
+    name, cards = lookup(original)
 
-    request = BASE_REQUEST + '?name=' + name
-    r = requests.get(request)
-    cards = r.json()
+    # Only if nothing matches, correct typos using the card names we already
+    # know. (A correct name for a card we don't know yet could otherwise be
+    # "corrected" to a similar one we do.)
+    if not cards:
+        corrected = fuzzy.correct(original)
+        if corrected and corrected != original:
+            name, cards = lookup(corrected)
 
-    if cards and (r.status_code == requests.codes.ok):
+    if cards:
         # Grab split status and Multiverse ID to resolve split card confusion.
         split = [any([e.get('layout') == 'split'
                      for e in c.get('editions', [])])
@@ -56,14 +217,12 @@ def find_card(name):
                 if not m_ids[i]:
                     print('Unable to find a Multiverse ID for "{}". This '
                           'usually occurs when a card exists only as a promo.'
-                          ' Sorry!').format(cards[i])
+                          ' Sorry!'.format(cards[i]['name']))
                     continue
 
-                request = BASE_REQUEST + '?m={}'.format(m_ids[i][0])
-                r = requests.get(request)
-                card_pair = r.json()
+                card_pair = find_printing(m_ids[i][0])
 
-                if len(card_pair) == 2 and (r.status_code==requests.codes.ok):
+                if len(card_pair) == 2:
                     # Might be listed in the wrong order.
                     reverse = 'b' in card_pair[0]['editions'][0].get('number')
 
@@ -101,33 +260,196 @@ def find_card_name(name):
     return [c.get('name') for c in find_card(name)]
 
 
+def search(name):
+    """
+    Returns the cards whose names match the specified name. The local catalog
+    is searched first; DeckBrew is only queried if it has no matches.
+    """
+    cards = catalog.search(name)
+
+    if not cards:
+        r = get_client().get(BASE_REQUEST + '?name=' + name)
+        cards = r.json() if r.status_code == requests.codes.ok else []
+
+    return cards
+
+
+def printing(multiverse_id):
+    """
+    Returns the cards printed with the specified Multiverse ID (both halves,
+    for split cards). The local catalog is searched before DeckBrew.
+    """
+    cards = catalog.by_multiverse_id(multiverse_id)
+
+    if not cards:
+        r = get_client().get(BASE_REQUEST + '?m={}'.format(multiverse_id))
+        cards = r.json() if r.status_code == requests.codes.ok else []
+
+    return cards
+
+
 def release_date(set_name):
     """
-    Searches a Wikipedia article using regular expressions (I know, I know...)
-    to determine the release date of a given set.
+    Determines the release date of a given set.
+    """
+    return release_dates([set_name])[set_name]
+
+
+def release_dates(set_names, index=None):
+    """
+    Determines the release dates of many sets at once. Returns a dictionary
+    mapping each set name to its release date (or None, if it's not known).
+    Dates are looked up in the index from Wikipedia, unless another one (a
+    dictionary mapping set names to dates) is given.
+    """
+    if index is None:
+        index = release_date_index()
+    dates = {}
+
+    for set_name in set_names:
+        name = set_name.replace(' "Timeshifted"', '')
+        d = index.get(name) or index.get(ALTERNATE_NAMES.get(name))
+
+        if not d:
+            print('Warning: No release date found for {}.'.format(set_name))
+
+        dates[set_name] = d
+
+    return dates
+
+
+def release_date_index():
+    """
+    Returns a dictionary mapping set names to release dates. The index is
+    built from Wikipedia once, then kept in memory and on disk (at
+    RELEASE_DATE_FILE) until it is more than RELEASE_DATE_TTL seconds old.
+    If the download fails, whatever dates there are (if any) are used, and it
+    isn't tried again for RELEASE_DATE_RETRY seconds.
     """
-    set_name = set_name.replace(' "Timeshifted"', '')
-    d = None
+    global _release_dates, _release_failed
+
+    ttl = app.config.get('RELEASE_DATE_TTL', 60 * 60 * 24 * 7)
+    retry = app.config.get('RELEASE_DATE_RETRY', 60 * 10)
+
+    with _release_lock:
+        if _release_dates is None:
+            _release_dates = load_release_dates()
+
+        stale = (_release_dates is None or
+                 time() - _release_dates['fetched'] > ttl)
+        backing_off = (_release_failed is not None and
+                       time() - _release_failed < retry)
+
+        if stale and not backing_off:
+            index = download_release_dates()
+
+            if index is not None:
+                _release_dates = {'fetched': time(), 'dates': index}
+                _release_failed = None
+                save_release_dates(_release_dates)
+            else:
+                _release_failed = time()
+
+        return _release_dates['dates'] if _release_dates else {}
+
+
+def download_release_dates():
+    """
+    Parses the table of sets in a Wikipedia article to determine the release
+    date of every set. Returns None if the article can't be fetched.
+    """
+    index = {}
+
+    try:
+        r = get_client().get(WIKIPEDIA_SETS)
+    except requests.RequestException as e:
+        print("Warning: Can't fetch release dates. Unable to connect to {}: {}"
+              .format(WIKIPEDIA_SETS, e))
+        return None
 
-    request = 'http://en.wikipedia.org/wiki/List_of_Magic:_The_Gathering_sets'
-    r = requests.get(request)
     html = r.text
 
-    if html and (r.status_code == requests.codes.ok):
-        pattern = r'<td><i.*?>' + set_name + r'<.*?\/i>.*?<\/td>\n?(<td>.*?\n?.*?<\/td>\n?){2,4}<td>(.*? [0-9]{4})<'
-        match = re.search(pattern, html)
-
-        if match:
-            match = match.groups()
-            try:
-                d = parse(match[-1], default=date(1993, 1, 1))
-            except:
-                print("Warning: Can't fetch release date for {}. Unknown "
-                      'format "{}".'.format(set_name, match[-1]))
+    if not (html and (r.status_code == requests.codes.ok)):
+        print("Warning: Can't fetch release dates. Unable to connect to {}."
+              .format(WIKIPEDIA_SETS))
+        return None
+
+    soup = BeautifulSoup(html, 'html.parser')
+
+    for row in soup.find_all('tr'):
+        cells = row.find_all('td', recursive=False)
+
+        # The set name is the first italicized cell, and the release date is
+        # three to five cells after it.
+        for i, cell in enumerate(cells):
+            if cell.i:
+                break
         else:
-            print('Warning: No release date found for {}.'.format(set_name))
-    else:
-        print("Warning: Can't fetch release date for {}. Unable to connect to"
-              "{}.".format(set_name, request))
+            continue
+
+        set_name = cell.i.get_text().strip()
+        if set_name in index:
+            continue
+
+        for cell in cells[i + 3:i + 6]:
+            text = next(cell.strings, '').strip()
+
+            if re.match(r'.* [0-9]{4}$', text):
+                try:
+                    index[set_name] = parse(
+                        text, default=datetime(1993, 1, 1)
+                    ).date()
+                except:
+                    print("Warning: Can't fetch release date for {}. Unknown "
+                          'format "{}".'.format(set_name, text))
+                break
+
+    return index
+
+
+def load_release_dates():
+    """
+    Reads the release date index from RELEASE_DATE_FILE, if there is one.
+    """
+    file_name = app.config.get('RELEASE_DATE_FILE')
+    if not (file_name and path.exists(file_name)):
+        return None
+
+    try:
+        with open(file_name, 'r') as f:
+            cache = json.load(f)
+
+        return {
+            'fetched': cache['fetched'],
+            'dates': {
+                name: datetime.strptime(d, '%Y-%m-%d').date()
+                for name, d in cache['dates'].items()
+            }
+        }
+
+    except Exception as e:
+        print('Warning: Unable to read release dates from {}: {}'
+              .format(file_name, e))
+        return None
+
+
+def save_release_dates(cache):
+    """
+    Writes the release date index to RELEASE_DATE_FILE, if one is configured.
+    """
+    file_name = app.config.get('RELEASE_DATE_FILE')
+    if not file_name:
+        return
+
+    try:
+        with open(file_name, 'w') as f:
+            json.dump({
+                'fetched': cache['fetched'],
+                'dates': {
+                    name: d.isoformat() for name, d in cache['dates'].items()
+                }
+            }, f)
 
-    return d
+    except Exception as e:
+        print('Warning: Unable to write release dates to {}: {}'
+              .format(file_name, e))
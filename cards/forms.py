@@ -17,6 +17,8 @@ class BrowseForm(Form):
     type = HiddenField(default='')
     set = HiddenField(default='')
     collection = HiddenField(default='')
+    page = HiddenField(default='1')
+    cursor = HiddenField(default='')
 
 
 class DetailsForm(Form):
@@ -28,3 +30,11 @@ class AddForm(Form):
     want = IntegerField('Want', default=app.config['DEFAULT_WANT'],
                         validators=[NumberRange(min=0)])
 
+
+
+class UpdateForm(Form):
+    action = HiddenField(default='start')
+
+
+class IncrementForm(Form):
+    changes = HiddenField(default='[]')
@@ -0,0 +1,134 @@
+from collections import Counter, defaultdict
+from threading import Lock
+import re, unicodedata
+
+from cards import app, db, catalog
+from cards.models import Card
+
+
+# Known card names by normalized name, and normalized names by trigram.
+_names = {}
+_trigrams = defaultdict(set)
+_sizes = {}
+_built = False
+_lock = Lock()
+
+
+def normalize(name):
+    """
+    Lowercases a card name, strips accents, and replaces punctuation with
+    spaces, so that "Lim-Dûl's Vault" matches "lim dul s vault" and
+    "Fire//Ice" matches "Fire // Ice".
+    """
+    name = name.lower().replace('\xe6', 'ae')
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', name).split())
+
+
+def trigrams(normalized):
+    """
+    Returns the set of three-character sequences in a normalized name (padded,
+    so that the beginning and end of the name count for more).
+    """
+    padded = '  ' + normalized + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def add(names):
+    """
+    Adds card names to the index.
+    """
+    with _lock:
+        for name in names:
+            normalized = normalize(name)
+            if not normalized or normalized in _names:
+                continue
+
+            grams = trigrams(normalized)
+            _names[normalized] = name
+            _sizes[normalized] = len(grams)
+            for gram in grams:
+                _trigrams[gram].add(normalized)
+
+
+def build():
+    """
+    Indexes the names of every card in the local catalog and the DB. This is
+    done automatically the first time the index is used.
+    """
+    global _built
+
+    from cards import providers
+
+    if _built:
+        return
+
+    # The local provider loads its catalog when it's created.
+    providers.get()
+
+    add(catalog.names())
+    add(name for name, in db.session.query(Card.name))
+
+    _built = True
+
+
+def candidates(name, limit=10, threshold=0.3):
+    """
+    Returns up to limit (name, similarity) tuples for the known card names
+    most similar to the name provided, best first. Similarity is the Jaccard
+    index of the names' trigrams (between 0 and 1); names less similar than
+    threshold are left out.
+    """
+    build()
+
+    normalized = normalize(name)
+    grams = trigrams(normalized)
+
+    shared = Counter()
+    with _lock:
+        for gram in grams:
+            shared.update(_trigrams.get(gram, ()))
+
+        scores = [
+            (_names[n], count / (len(grams) + _sizes[n] - count))
+            for n, count in shared.items()
+        ]
+
+    scores = [s for s in scores if s[1] >= threshold]
+    scores.sort(key=lambda s: (-s[1], s[0]))
+
+    return scores[:limit]
+
+
+def exact(name):
+    """
+    Returns the known card name that is identical to the name provided once
+    both are normalized (differing only in case, accents, punctuation, or
+    spacing), or None if there isn't one.
+    """
+    build()
+
+    with _lock:
+        return _names.get(normalize(name))
+
+
+def correct(name):
+    """
+    Returns the known card name that the name provided is most likely meant to
+    be, or None if there's no clear winner. The best match must be identical
+    once normalized, or be at least FUZZY_THRESHOLD similar and noticeably
+    better than the runner-up.
+    """
+    threshold = app.config.get('FUZZY_THRESHOLD', 0.7)
+    matches = candidates(name, limit=2, threshold=threshold)
+
+    if not matches:
+        return None
+
+    if (matches[0][1] < 1 and len(matches) > 1 and
+            matches[0][1] - matches[1][1] < 0.1):
+        return None
+
+    return matches[0][0]
+
@@ -0,0 +1,254 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from time import sleep
+
+from cards import app, db, controller
+from cards.models import Job, Card
+
+
+ACTIVE = ['queued', 'running']
+RESUMABLE = ['cancelled', 'failed', 'interrupted']
+
+_executor = None
+_heartbeat = None
+_lock = Lock()
+
+# IDs of the jobs submitted to this process that haven't started yet, and of
+# those that are running. These are never submitted again, however long it
+# has been since they last checked in.
+_waiting = set()
+_running = set()
+
+
+def start(user, kind='update_db'):
+    """
+    Starts a job in the background and returns it. If the user already has an
+    active job of the same kind, that job is returned instead. If there is an
+    unfinished one, it is resumed from where it left off.
+    """
+    job = latest(user, kind)
+
+    if job and status(job) in ACTIVE:
+        return job
+
+    if job and status(job) in RESUMABLE:
+        return resume(job)
+
+    job = Job(
+        kind=kind, status='queued', progress=0, total=0, failures=0,
+        cancel_requested=False, created_at=datetime.utcnow(),
+        updated_at=datetime.utcnow(), user_id=user.id
+    )
+    db.session.add(job)
+    controller.commit()
+
+    submit(job.id)
+    return job
+
+
+def resume(job):
+    """
+    Restarts a cancelled, failed, or interrupted job from its last checkpoint.
+    Jobs that are still queued or running in this process are left alone.
+    """
+    if is_active(job.id):
+        return job
+
+    job.status = 'queued'
+    job.cancel_requested = False
+    job.error = None
+    job.updated_at = datetime.utcnow()
+    controller.commit()
+
+    submit(job.id)
+    return job
+
+
+def cancel(job):
+    """
+    Asks a job to stop. It will do so after it finishes the current card.
+    """
+    if status(job) in ACTIVE:
+        job.cancel_requested = True
+        controller.commit()
+
+    return job
+
+
+def latest(user, kind='update_db'):
+    """
+    Returns the user's most recent job of the specified kind (or None).
+    """
+    return user.jobs.filter(Job.kind == kind).order_by(Job.id.desc()).first()
+
+
+def status(job):
+    """
+    Returns the status of a job. Jobs that are supposedly active but haven't
+    checked in for JOB_TIMEOUT seconds (because the server was restarted, for
+    example) are reported as "interrupted", unless they are queued or running
+    in this process.
+    """
+    timeout = timedelta(seconds=app.config.get('JOB_TIMEOUT', 300))
+
+    if (job.status in ACTIVE and job.updated_at and
+            datetime.utcnow() - job.updated_at > timeout and
+            not is_active(job.id)):
+        return 'interrupted'
+
+    return job.status
+
+
+def is_active(job_id):
+    """
+    Returns True if a job is queued or running in this process.
+    """
+    with _lock:
+        return job_id in _waiting or job_id in _running
+
+
+def submit(job_id):
+    """
+    Runs a job on the pool of JOB_WORKERS background threads (unless it's
+    already queued or running). While it waits its turn, its updated_at is
+    kept current, so that it isn't mistaken for an interrupted job.
+    """
+    global _executor, _heartbeat
+
+    with _lock:
+        if job_id in _waiting or job_id in _running:
+            return
+
+        _waiting.add(job_id)
+
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config.get('JOB_WORKERS', 2)
+            )
+
+        if _heartbeat is None:
+            _heartbeat = Thread(
+                target=_beat, name='job-heartbeat', daemon=True
+            )
+            _heartbeat.start()
+
+    _executor.submit(run, job_id)
+
+
+def _beat():
+    """
+    Updates the updated_at of the jobs waiting in the queue every third of
+    JOB_TIMEOUT, until there are none left.
+    """
+    global _heartbeat
+
+    interval = app.config.get('JOB_TIMEOUT', 300) / 3
+
+    while True:
+        sleep(interval)
+
+        with _lock:
+            waiting = list(_waiting)
+            if not waiting:
+                _heartbeat = None
+                return
+
+        with app.app_context():
+            try:
+                Job.query.filter(
+                    Job.id.in_(waiting), Job.status == 'queued'
+                ).update(
+                    {Job.updated_at: datetime.utcnow()},
+                    synchronize_session=False
+                )
+                db.session.commit()
+            except Exception as e:
+                print('Warning: Unable to update waiting jobs: {}'.format(e))
+                db.session.rollback()
+
+
+def run(job_id):
+    """
+    Runs a job to completion (or until it is cancelled or fails).
+    """
+    with _lock:
+        _waiting.discard(job_id)
+        _running.add(job_id)
+
+    try:
+        _run(job_id)
+    finally:
+        with _lock:
+            _running.discard(job_id)
+
+
+def _run(job_id):
+    with app.app_context():
+        job = Job.query.get(job_id)
+
+        try:
+            job.status = 'running'
+            job.updated_at = datetime.utcnow()
+            controller.commit()
+
+            TASKS[job.kind](job)
+
+        except Exception as e:
+            print('Error: Job {} failed: {}'.format(job_id, e))
+            db.session.rollback()
+
+            job.status = 'failed'
+            job.error = str(e)
+            job.updated_at = datetime.utcnow()
+            controller.commit()
+
+
+def update_db(job):
+    """
+    Updates every card in the user's DB with the latest information from
+    DeckBrew, in alphabetical order. The name of the last card updated is
+    saved after each card, so the job can be resumed from there.
+    """
+    user = job.user
+
+    if not job.total:
+        job.total = user.cards.count()
+
+    names = [
+        name for name, in db.session.query(Card.name).filter(
+            Card.user_id == user.id, Card.name > (job.checkpoint or '')
+        ).order_by(Card.name)
+    ]
+
+    for name in names:
+        # Cancellation is requested by another thread (or process).
+        db.session.refresh(job)
+        if job.cancel_requested:
+            job.status = 'cancelled'
+            job.updated_at = datetime.utcnow()
+            controller.commit()
+            return
+
+        try:
+            controller.add_card(user, name)
+        except Exception as e:
+            print('Warning: Unable to update {}: {}'.format(name, e))
+
+            # Don't commit whatever store_card had added before it failed.
+            controller.rollback()
+            job.failures += 1
+
+        job.checkpoint = name
+        job.progress += 1
+        job.updated_at = datetime.utcnow()
+        controller.commit()
+
+    job.status = 'complete'
+    job.updated_at = datetime.utcnow()
+    controller.commit()
+
+
+TASKS = {
+    'update_db': update_db
+}
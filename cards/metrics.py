@@ -0,0 +1,281 @@
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+from time import time
+from flask import g, request, has_request_context, Response, abort
+from flask.ext.login import current_user
+from hmac import compare_digest
+from sqlalchemy import event
+
+from cards import app, db, authenticate, deckbrew, prices
+
+
+# Upper bounds (in seconds, or statements) of the histogram buckets.
+SECONDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+STATEMENTS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+_lock = Lock()
+
+
+class Histogram:
+    """
+    Counts observations in cumulative buckets, the way Prometheus does.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i in range(bisect_left(self.buckets, value), len(self.buckets)):
+            self.counts[i] += 1
+
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        """
+        Returns the histogram in the Prometheus text format.
+        """
+        lines = [
+            '{}_bucket{} {}'.format(
+                name, format_labels(labels, le=bound), count
+            )
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append('{}_bucket{} {}'.format(
+            name, format_labels(labels, le='+Inf'), self.count
+        ))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels),
+                                          self.sum))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels),
+                                            self.count))
+        return lines
+
+
+# Aggregated across all requests (and background threads), since startup.
+durations = defaultdict(lambda: Histogram(SECONDS))
+statements = defaultdict(lambda: Histogram(STATEMENTS))
+totals = defaultdict(float)
+scrapes = Histogram(SECONDS)
+
+
+def format_labels(labels, **extra):
+    labels = sorted(list(labels) + list(extra.items()))
+    if not labels:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"'))
+        for key, value in labels
+    ) + '}'
+
+
+def record(kind, elapsed):
+    """
+    Counts an SQL statement, HTTP request, price scrape, or LDAP request (and
+    how long it took), both for the current request (if there is one) and in
+    total.
+    """
+    with _lock:
+        totals[(kind, 'count')] += 1
+        totals[(kind, 'seconds')] += elapsed
+
+    if has_request_context() and hasattr(g, 'metrics'):
+        g.metrics[kind][0] += 1
+        g.metrics[kind][1] += elapsed
+
+
+@event.listens_for(db.engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(time())
+
+
+@event.listens_for(db.engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    record('sql', time() - conn.info['query_start'].pop())
+
+
+def http_listener(url, status, elapsed):
+    record('http', elapsed)
+
+
+def scrape_listener(edition_id, succeeded, elapsed):
+    record('scrape', elapsed)
+
+    with _lock:
+        scrapes.observe(elapsed)
+        if not succeeded:
+            totals[('scrape', 'errors')] += 1
+
+
+def ldap_listener(kind, succeeded, elapsed):
+    record('ldap', elapsed)
+
+    if not succeeded:
+        with _lock:
+            totals[('ldap', 'failures')] += 1
+
+
+deckbrew.get_client().listeners.append(http_listener)
+prices.listeners.append(scrape_listener)
+authenticate.listeners.append(ldap_listener)
+
+
+@app.before_request
+def start_request():
+    g.metrics = {'start': time(), 'sql': [0, 0.0], 'http': [0, 0.0],
+                 'scrape': [0, 0.0], 'ldap': [0, 0.0]}
+
+
+@app.after_request
+def finish_request(response):
+    """
+    Adds the request to the histograms for its route, and reports it if it
+    took longer than SLOW_REQUEST_THRESHOLD seconds.
+    """
+    metrics = g.pop('metrics', None)
+    if metrics is None:
+        return response
+
+    elapsed = time() - metrics['start']
+    labels = (('route', request.endpoint or 'unknown'),
+              ('method', request.method))
+
+    with _lock:
+        durations[labels].observe(elapsed)
+        statements[labels].observe(metrics['sql'][0])
+
+    if elapsed > app.config.get('SLOW_REQUEST_THRESHOLD', 1):
+        print(
+            'Slow request: {} {} ({}) took {:.3f}s. SQL: {} statements in '
+            '{:.3f}s. DeckBrew: {} requests in {:.3f}s. Price scrapes: {} in '
+            '{:.3f}s. LDAP: {} requests in {:.3f}s.'.format(
+                request.method, request.full_path.rstrip('?'),
+                response.status_code, elapsed, metrics['sql'][0],
+                metrics['sql'][1], metrics['http'][0], metrics['http'][1],
+                metrics['scrape'][0], metrics['scrape'][1], metrics['ldap'][0],
+                metrics['ldap'][1]
+            )
+        )
+
+    return response
+
+
+def allowed():
+    """
+    Returns True if the current request may read the metrics: it comes from
+    an address in METRICS_ALLOWED_ADDRESSES, carries METRICS_TOKEN as a bearer
+    token (for scrapers), or is from a logged-in admin.
+    """
+    if request.remote_addr in app.config.get('METRICS_ALLOWED_ADDRESSES', []):
+        return True
+
+    token = app.config.get('METRICS_TOKEN')
+    header = request.headers.get('Authorization', '')
+    if token and compare_digest(header.encode(),
+                                'Bearer {}'.format(token).encode()):
+        return True
+
+    return current_user.is_authenticated and current_user.is_admin()
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Reports request, SQL, DeckBrew, price scraping, and LDAP metrics in the
+    Prometheus text format.
+    """
+    if not allowed():
+        abort(403)
+
+    lines = []
+
+    def metric(name, kind, description):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+    with _lock:
+        metric('cards_request_duration_seconds', 'histogram',
+               'Time taken to handle requests, by route.')
+        for labels, histogram in sorted(durations.items()):
+            lines += histogram.lines('cards_request_duration_seconds', labels)
+
+        metric('cards_request_sql_statements', 'histogram',
+               'SQL statements executed per request, by route.')
+        for labels, histogram in sorted(statements.items()):
+            lines += histogram.lines('cards_request_sql_statements', labels)
+
+        for kind, description in [
+            ('sql', 'SQL statements'), ('http', 'DeckBrew requests'),
+            ('scrape', 'price scrapes'), ('ldap', 'LDAP requests')
+        ]:
+            metric('cards_{}_total'.format(kind), 'counter',
+                   'Number of {}.'.format(description))
+            lines.append('cards_{}_total {}'.format(
+                kind, int(totals[(kind, 'count')])
+            ))
+
+            metric('cards_{}_seconds_total'.format(kind), 'counter',
+                   'Time spent on {}.'.format(description))
+            lines.append('cards_{}_seconds_total {}'.format(
+                kind, totals[(kind, 'seconds')]
+            ))
+
+        metric('cards_scrape_errors_total', 'counter',
+               'Number of price scrapes that failed.')
+        lines.append('cards_scrape_errors_total {}'.format(
+            int(totals[('scrape', 'errors')])
+        ))
+
+        metric('cards_scrape_duration_seconds', 'histogram',
+               'Time taken to scrape a price.')
+        lines += scrapes.lines('cards_scrape_duration_seconds', ())
+
+        metric('cards_ldap_failures_total', 'counter',
+               'Number of LDAP searches and binds that failed (including '
+               'wrong passwords).')
+        lines.append('cards_ldap_failures_total {}'.format(
+            int(totals[('ldap', 'failures')])
+        ))
+
+    price_statistics = prices.statistics()
+
+    metric('cards_price_cache_total', 'counter',
+           'Price cache lookups and refreshes, by result.')
+    for key in sorted(prices.counters):
+        lines.append('cards_price_cache_total{} {}'.format(
+            format_labels((), result=key), price_statistics[key]
+        ))
+
+    metric('cards_price_pending', 'gauge',
+           'Prices waiting to be scraped, by queue.')
+    for key in ['queued', 'scraping']:
+        lines.append('cards_price_pending{} {}'.format(
+            format_labels((), queue=key), price_statistics[key]
+        ))
+
+    login_statistics = authenticate.statistics()
+
+    metric('cards_login_cache_total', 'counter',
+           'LDAP directory and user cache lookups, by cache and result.')
+    for cache in ['directory', 'user']:
+        for result in ['hits', 'misses']:
+            lines.append('cards_login_cache_total{} {}'.format(
+                format_labels((), cache=cache, result=result),
+                login_statistics['{}_{}'.format(cache, result)]
+            ))
+
+    metric('cards_login_cache_entries', 'gauge',
+           'Entries in the LDAP directory and user caches.')
+    for cache, key in [('directory', 'directory_entries'), ('user', 'users')]:
+        lines.append('cards_login_cache_entries{} {}'.format(
+            format_labels((), cache=cache), login_statistics[key]
+        ))
+
+    return Response('\n'.join(lines) + '\n',
+                    mimetype='text/plain; version=0.0.4')
@@ -1,9 +1,11 @@
-from functools import reduce
+from functools import reduce, lru_cache
 from flask import url_for
-from bs4 import BeautifulSoup
-import dryscrape, re
+from sqlalchemy import case, event, inspect
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.schema import CreateColumn
+import re
 
-from cards import app, db
+from cards import app, db, prices
 
 
 COLOR_MASK = {'White': 0x01, 'Blue': 0x02, 'Black': 0x04, 'Red': 0x08,
@@ -49,6 +51,91 @@ DECKBREW_URL = 'https://api.deckbrew.com/mtg/cards?multiverseid={}'
 MCI_URL = 'http://magiccards.info/{}/en/{}.html'
 
 
+MANA_SYMBOL = re.compile(r'{([^/]?)/?([^/]?)}')
+
+# The full-text index over card names, type lines, and rules text. It's an
+# external content table (it indexes the card table rather than storing its
+# own copy), kept in sync by triggers.
+SEARCH_INDEX = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS card_search USING fts5(
+        name, type_line, text, content='card', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS card_search_insert
+    AFTER INSERT ON card BEGIN
+        INSERT INTO card_search(rowid, name, type_line, text)
+        VALUES (new.id, new.name, new.type_line, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS card_search_delete
+    AFTER DELETE ON card BEGIN
+        INSERT INTO card_search(card_search, rowid, name, type_line, text)
+        VALUES ('delete', old.id, old.name, old.type_line, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS card_search_update
+    AFTER UPDATE OF name, type_line, text ON card BEGIN
+        INSERT INTO card_search(card_search, rowid, name, type_line, text)
+        VALUES ('delete', old.id, old.name, old.type_line, old.text);
+        INSERT INTO card_search(rowid, name, type_line, text)
+        VALUES (new.id, new.name, new.type_line, new.text);
+    END
+    """
+]
+
+# Set by create_search_index.
+full_text_search = False
+
+# Keep each card's have_total equal to the sum of its editions' have values,
+# however the editions are written (including by bulk UPDATE statements).
+HAVE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS edition_have_insert
+    AFTER INSERT ON edition BEGIN
+        UPDATE card SET have_total = have_total + coalesce(new.have, 0)
+        WHERE id = new.card_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS edition_have_delete
+    AFTER DELETE ON edition BEGIN
+        UPDATE card SET have_total = have_total - coalesce(old.have, 0)
+        WHERE id = old.card_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS edition_have_update
+    AFTER UPDATE OF have, card_id ON edition BEGIN
+        UPDATE card SET have_total = have_total - coalesce(old.have, 0)
+        WHERE id = old.card_id;
+        UPDATE card SET have_total = have_total + coalesce(new.have, 0)
+        WHERE id = new.card_id;
+    END
+    """
+]
+
+# Recomputes every card's have_total from scratch.
+HAVE_TOTALS = """
+    UPDATE card SET have_total = (
+        SELECT coalesce(sum(edition.have), 0) FROM edition
+        WHERE edition.card_id = card.id
+    )
+"""
+
+# Set by create_have_triggers. Without the triggers, have_total is maintained
+# by the ORM events at the bottom of this module instead.
+have_triggers = False
+
+# Statements that fill in columns added to existing tables by migrate.
+BACKFILLS = {
+    ('card', 'have_total'): HAVE_TOTALS
+}
+
+
 def byte_to_set(mask, b):
     return {key for key, value in mask.items() if (value & b)}
 
@@ -57,11 +144,145 @@ def set_to_byte(mask, s):
     return reduce(lambda x, y: x | mask.get(y, 0x00), s, 0x00)
 
 
+def migrate():
+    """
+    Adds any columns and indexes that are missing from existing tables
+    (db.create_all only creates tables that don't exist yet), filling in the
+    new columns that need it. Safe to run every time the app starts.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            columns = {c['name'] for c in inspector.get_columns(table.name)}
+            indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+
+                print('Adding column {}.{}.'.format(table.name, column.name))
+                connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                    engine.dialect.identifier_preparer.format_table(table),
+                    CreateColumn(column).compile(dialect=engine.dialect)
+                ))
+
+                if (table.name, column.name) in BACKFILLS:
+                    connection.execute(BACKFILLS[(table.name, column.name)])
+
+            for index in table.indexes:
+                if index.name not in indexes:
+                    print('Adding index {}.'.format(index.name))
+                    index.create(connection)
+
+
+def color_name(color_byte):
+    colors = byte_to_set(COLOR_MASK, color_byte)
+    if len(colors) == 0:
+        return 'Colorless'
+    elif len(colors) > 1:
+        return 'Mulitcolored'
+    else:
+        return colors.pop()
+
+
+def type_name(type_byte):
+    # Sets of strings iterate in a different order in each process, so the
+    # types are put in mask order (e.g., "Artifact Creature", "Tribal
+    # Instant"). Statistics are keyed by this, so it must be stable.
+    return " ".join(sorted(byte_to_set(TYPE_MASK, type_byte),
+                           key=TYPE_MASK.get))
+
+
+def create_search_index():
+    """
+    Creates the full-text search index (and the triggers that maintain it) if
+    they don't already exist, indexing any cards already in the DB. This
+    requires SQLite with FTS5; otherwise, searches fall back on pattern
+    matching.
+    """
+    global full_text_search
+
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+
+    try:
+        with engine.begin() as connection:
+            exists = connection.execute(
+                "SELECT name FROM sqlite_master WHERE name = 'card_search'"
+            ).scalar()
+
+            for statement in SEARCH_INDEX:
+                connection.execute(statement)
+
+            if not exists:
+                connection.execute(
+                    "INSERT INTO card_search(card_search) VALUES ('rebuild')"
+                )
+
+    except Exception as e:
+        print('Warning: Unable to create full-text search index: {}'
+              .format(e))
+        return
+
+    full_text_search = True
+
+
+def create_have_triggers():
+    """
+    Creates the triggers that maintain Card.have_total if they don't already
+    exist, totalling any cards already in the DB. This requires SQLite; other
+    DBs rely on the ORM events below (which don't see bulk UPDATEs).
+    """
+    global have_triggers
+
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+
+    with engine.begin() as connection:
+        exists = connection.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'edition_have_insert'"
+        ).scalar()
+
+        for statement in HAVE_TRIGGERS:
+            connection.execute(statement)
+
+        if not exists:
+            connection.execute(HAVE_TOTALS)
+
+    have_triggers = True
+
+
+@lru_cache(maxsize=1024)
+def mana_html(cost):
+    """
+    Renders a mana cost (e.g., "{2}{W/U}") as a row of symbols from the sprite
+    sheet (see mana.css). There are few distinct costs, so they are memoized.
+    """
+    if not cost:
+        return ''
+
+    symbols = [
+        '<span class="mana-symbol mana-{}{}"></span>'.format(
+            m.group(1), m.group(2)
+        )
+        for m in MANA_SYMBOL.finditer(cost)
+    ]
+    return '<div class="mana">{}</div>'.format("".join(symbols))
+
+
 class User(db.Model):
     id = db.Column(db.String(64), primary_key=True)
     name = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(128), index=True)
 
+    # Incremented whenever the collection changes (see controller.touch).
+    version = db.Column(db.Integer, default=0, server_default='0',
+                        nullable=False)
+
     sets = db.relationship(
         'Set', backref='user', lazy='dynamic', cascade='all, delete-orphan'
     )
@@ -71,6 +292,13 @@ class User(db.Model):
     cards = db.relationship(
         'Card', backref='user', lazy='dynamic', cascade='all, delete-orphan'
     )
+    jobs = db.relationship(
+        'Job', backref='user', lazy='dynamic', cascade='all, delete-orphan'
+    )
+    statistics = db.relationship(
+        'Statistic', backref='user', lazy='dynamic',
+        cascade='all, delete-orphan'
+    )
 
     def __repr__(self):
         return '<User {}>'.format(self.id)
@@ -101,6 +329,10 @@ class Set(db.Model):
     """
     Represents the various expansions, promotional releases, & collectors sets.
     """
+    __table_args__ = (
+        db.Index('ix_set_release_date_name', 'release_date', 'name'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(4), index=True)
     name = db.Column(db.String, index=True, unique=True)
@@ -141,6 +373,8 @@ class Card(db.Model):
     name = db.Column(db.String(150), index=True, unique=True)
     color_byte = db.Column(db.SmallInteger)
     type_byte = db.Column(db.SmallInteger)
+    type_line = db.Column(db.String(150))
+    text = db.Column(db.Text)
     cost = db.Column(db.String(20))
     power = db.Column(db.String(3))
     toughness = db.Column(db.String(3))
@@ -148,6 +382,11 @@ class Card(db.Model):
     important = db.Column(db.Boolean, default=False)
     uncertain = db.Column(db.Boolean, default=False)
 
+    # Total copies owned across all editions. Maintained by triggers (see
+    # create_have_triggers), so it should never be assigned to directly.
+    have_total = db.Column(db.Integer, default=0, server_default='0',
+                           nullable=False, index=True)
+
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
     editions = db.relationship(
@@ -160,17 +399,33 @@ class Card(db.Model):
     def __str__(self):
         return '<Card {}>'.format(self.name)
 
-    @property
+    @hybrid_property
     def have(self):
-        return sum(e.have for e in self.editions)
+        return self.have_total or 0
 
-    @property
+    @have.expression
+    def have(cls):
+        return cls.have_total
+
+    @hybrid_property
     def need(self):
-        return max(self.want - self.have, 0)
+        return max((self.want or 0) - self.have, 0)
 
-    @property
+    @need.expression
+    def need(cls):
+        return case(
+            [(cls.want > cls.have_total, cls.want - cls.have_total)], else_=0
+        )
+
+    @hybrid_property
     def extra(self):
-        return max(self.have - self.want, 0)
+        return max(self.have - (self.want or 0), 0)
+
+    @extra.expression
+    def extra(cls):
+        return case(
+            [(cls.have_total > cls.want, cls.have_total - cls.want)], else_=0
+        )
 
     @property
     def colors(self):
@@ -186,17 +441,11 @@ class Card(db.Model):
 
     @property
     def color(self):
-        colors = self.colors
-        if len(colors) == 0:
-            return 'Colorless'
-        elif len(colors) > 1:
-            return 'Mulitcolored'
-        else:
-            return colors.pop()
+        return color_name(self.color_byte)
 
     @property
     def type(self):
-        return " ".join(self.types)
+        return type_name(self.type_byte)
 
     @property
     def editions_by_release(self):
@@ -210,18 +459,7 @@ class Card(db.Model):
 
     @property
     def web_cost(self):
-        if self.cost:
-            mana_tags = [
-                '<img src="{}">'.format(
-                    url_for('static', filename='{}{}.png'.format(
-                        m.group(1), m.group(2)
-                    ))
-                )
-                for m in re.finditer(r'{([^/]?)/?([^/]?)}', self.cost)
-            ]
-            return '<div class="mana">{}</div>'.format("".join(mana_tags))
-        else:
-            return ''
+        return mana_html(self.cost)
 
     def details(self, web=False):
         return {
@@ -242,7 +480,9 @@ class Card(db.Model):
                     'have': edition.have,
                     'collector_number': edition.collector_number,
                     'rarity': edition.rarity,
-                    'price': edition.price,
+                    # Missing prices are fetched by the page separately.
+                    'price': prices.lookup(edition, refresh=False),
+                    'price_current': edition.price_is_current,
                     'image_url': edition.image_url
                 }
                 for edition in self.editions_by_release.all()
@@ -254,6 +494,11 @@ class Edition(db.Model):
     """
     Represents a specific printing of a specific card.
     """
+    # Supports paging through editions in release order with an index seek.
+    __table_args__ = (
+        db.Index('ix_edition_set_number', 'set_id', 'collector_number'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     multiverse_id = db.Column(db.Integer, index=True)
     collector_number = db.Column(db.String(4), index=True)  # Supports DFCs.
@@ -264,6 +509,10 @@ class Edition(db.Model):
     card_id = db.Column(db.Integer, db.ForeignKey('card.id'))
     set_id = db.Column(db.Integer, db.ForeignKey('set.id'))
 
+    cached_price = db.relationship(
+        'Price', backref='edition', uselist=False, cascade='all, delete-orphan'
+    )
+
     def __repr__(self):
         return '<Edition {} ({})>'.format(self.card.name, self.set.code)
 
@@ -272,7 +521,8 @@ class Edition(db.Model):
 
     @property
     def image_url(self):
-        return DECKBREW_IMAGE.format(self.multiverse_id)
+        from cards import providers
+        return providers.get().image_url(self)
 
     @property
     def deckbrew_url(self):
@@ -284,21 +534,15 @@ class Edition(db.Model):
 
     @property
     def price(self):
-        price = None
-
-        # Unfortunately we need JavaScript support.
-        session = dryscrape.Session()
-        session.visit(self.mci_url)
-        response = session.body()
-
-        if response:
-            soup = BeautifulSoup(response, 'html.parser')
-            price_tag = soup.find('td', class_='TCGPPriceMid')
+        # Scraping MagicCards.info takes seconds, so this only ever returns
+        # the cached price. Missing or stale prices are refreshed in the
+        # background.
+        return prices.lookup(self)
 
-            if price_tag and price_tag.a:
-                price = price_tag.a.string
-
-        return price
+    @property
+    def price_is_current(self):
+        cached = self.cached_price
+        return cached is not None and not prices.is_stale(cached)
 
     def dict(self):
         return {
@@ -318,3 +562,153 @@ class Edition(db.Model):
             self.card.want,
             self.card.need
         )
+
+
+class Price(db.Model):
+    """
+    Represents the most recently scraped price of a specific printing.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    price = db.Column(db.String(20))
+    fetched_at = db.Column(db.DateTime, index=True)
+    source = db.Column(db.String(64))
+
+    edition_id = db.Column(
+        db.Integer, db.ForeignKey('edition.id'), index=True, unique=True
+    )
+
+    def __repr__(self):
+        return '<Price {} ({})>'.format(self.edition_id, self.price)
+
+    def __str__(self):
+        return '<Price {} ({})>'.format(self.edition_id, self.price)
+
+
+class Statistic(db.Model):
+    """
+    Represents a running total for part of a user's collection: the whole
+    collection (group "total", with an empty key) or the cards of one set,
+    color, type, or rarity. Maintained by the stats module.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'group', 'key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    group = db.Column(db.String(16))
+    key = db.Column(db.String(128))
+    owned = db.Column(db.Integer, default=0)
+    needed = db.Column(db.Integer, default=0)
+    value = db.Column(db.Integer, default=0)   # In cents.
+
+    user_id = db.Column(db.String(64), db.ForeignKey('user.id'), index=True)
+
+    def __repr__(self):
+        return '<Statistic {} {}>'.format(self.group, self.key)
+
+    def __str__(self):
+        return '<Statistic {} {}>'.format(self.group, self.key)
+
+    def dict(self):
+        return {
+            'group': self.group,
+            'key': self.key,
+            'owned': self.owned,
+            'needed': self.needed,
+            'value': self.value / 100
+        }
+
+
+class Job(db.Model):
+    """
+    Represents a long-running task (such as updating every card in the DB)
+    that is run in the background, and which can be cancelled and resumed.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32))
+    status = db.Column(db.String(16), index=True)
+    progress = db.Column(db.Integer, default=0)
+    total = db.Column(db.Integer, default=0)
+    failures = db.Column(db.Integer, default=0)
+    checkpoint = db.Column(db.String(150))   # The last card processed.
+    cancel_requested = db.Column(db.Boolean, default=False)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+    def __repr__(self):
+        return '<Job {}>'.format(self.id)
+
+    def __str__(self):
+        return '<Job {} ({})>'.format(self.kind, self.status)
+
+    def dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'failures': self.failures,
+            'checkpoint': self.checkpoint,
+            'error': self.error,
+            'created_at': self.created_at.isoformat()
+                if self.created_at else None,
+            'updated_at': self.updated_at.isoformat()
+                if self.updated_at else None
+        }
+
+
+def adjust_have_total(connection, card_id, change):
+    if card_id is not None and change:
+        card = Card.__table__
+        connection.execute(card.update().where(card.c.id == card_id).values(
+            have_total=card.c.have_total + change
+        ))
+
+
+@event.listens_for(Edition, 'after_insert')
+def edition_inserted(mapper, connection, edition):
+    if not have_triggers:
+        adjust_have_total(connection, edition.card_id, edition.have or 0)
+
+
+@event.listens_for(Edition, 'after_delete')
+def edition_deleted(mapper, connection, edition):
+    if not have_triggers:
+        adjust_have_total(connection, edition.card_id, -(edition.have or 0))
+
+
+@event.listens_for(Edition, 'before_update')
+def edition_updating(mapper, connection, edition):
+    """
+    Reads the edition's old count and card from the DB (they may not be
+    loaded) so that after_update can move the count between cards.
+    """
+    if have_triggers:
+        return
+
+    state = inspect(edition)
+    if not (state.attrs.have.history.has_changes() or
+            state.attrs.card_id.history.has_changes()):
+        return
+
+    table = Edition.__table__
+    connection.info.setdefault('editions_before', {})[edition.id] = \
+        connection.execute(
+            table.select().with_only_columns([table.c.have, table.c.card_id])
+            .where(table.c.id == edition.id)
+        ).first()
+
+
+@event.listens_for(Edition, 'after_update')
+def edition_updated(mapper, connection, edition):
+    if have_triggers:
+        return
+
+    old = connection.info.get('editions_before', {}).pop(edition.id, None)
+    if old is not None:
+        adjust_have_total(connection, old.card_id, -(old.have or 0))
+        adjust_have_total(connection, edition.card_id, edition.have or 0)
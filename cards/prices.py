@@ -0,0 +1,266 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from queue import Queue
+from threading import Lock, Thread
+from time import time
+from bs4 import BeautifulSoup
+import dryscrape
+
+from cards import app, db
+
+
+# How often reads were answered from the cache, how often there was nothing
+# cached, and how often the cached price was too old (but returned anyway).
+counters = {'hits': 0, 'misses': 0, 'stale': 0, 'refreshed': 0, 'errors': 0}
+
+# Functions called with the edition ID, whether it succeeded, and the duration
+# in seconds of every scrape.
+listeners = []
+
+_lock = Lock()
+_queue = Queue()
+_pending = set()
+_worker = None
+
+# Scrapes requested by refresh_many that haven't finished, by edition ID.
+_executor = None
+_inflight = {}
+
+
+def lookup(edition, refresh=True):
+    """
+    Returns the cached price of an edition without blocking. If there is no
+    cached price, or if it is older than PRICE_TTL seconds, the edition is
+    queued to be scraped by the background worker (unless refresh is False).
+    """
+    cached = edition.cached_price
+
+    if not refresh:
+        return cached.price if cached else None
+
+    if cached is None:
+        count('misses')
+        refresh(edition)
+        return None
+
+    if is_stale(cached):
+        count('stale')
+        refresh(edition)
+    else:
+        count('hits')
+
+    return cached.price
+
+
+def is_stale(cached):
+    ttl = timedelta(seconds=app.config.get('PRICE_TTL', 60 * 60 * 24))
+    return (cached.fetched_at is None or
+            datetime.utcnow() - cached.fetched_at > ttl)
+
+
+def refresh(edition):
+    """
+    Queues an edition to have its price scraped by the background worker.
+    Editions that are already queued are not queued again.
+    """
+    global _worker
+
+    with _lock:
+        if edition.id in _pending:
+            return
+
+        _pending.add(edition.id)
+        _queue.put(edition.id)
+
+        if _worker is None or not _worker.is_alive():
+            _worker = Thread(target=_work, name='price-worker', daemon=True)
+            _worker.start()
+
+
+def refresh_many(editions, timeout=None):
+    """
+    Scrapes the prices of whichever editions have missing or stale prices,
+    PRICE_WORKERS at a time, waiting at most timeout seconds (by default,
+    PRICE_REQUEST_TIMEOUT) for them to finish. Returns a dictionary mapping
+    edition IDs to prices, and a set of the IDs of editions that are still
+    being scraped. Those scrapes carry on, and are cached when they finish.
+    """
+    if timeout is None:
+        timeout = app.config.get('PRICE_REQUEST_TIMEOUT', 10)
+
+    results = {}
+    futures = {}
+
+    for edition in editions:
+        cached = edition.cached_price
+
+        if cached is not None and not is_stale(cached):
+            count('hits')
+            results[edition.id] = cached.price
+            continue
+
+        count('misses' if cached is None else 'stale')
+        futures[edition.id] = (submit(edition), cached)
+
+    if futures:
+        wait([future for future, cached in futures.values()], timeout=timeout)
+
+    pending = set()
+    for edition_id, (future, cached) in futures.items():
+        if not future.done():
+            pending.add(edition_id)
+        elif future.exception() is None:
+            results[edition_id] = future.result()
+        else:
+            # Fall back on the old price, if there was one.
+            results[edition_id] = cached.price if cached else None
+
+    return results, pending
+
+
+def submit(edition):
+    """
+    Starts scraping the price of an edition on the pool of PRICE_WORKERS
+    threads and returns the future. If the edition is already being scraped,
+    the existing future is returned instead.
+    """
+    global _executor
+
+    with _lock:
+        future = _inflight.get(edition.id)
+
+        if future is None:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=app.config.get('PRICE_WORKERS', 8)
+                )
+
+            future = _executor.submit(_fetch, edition.id)
+            _inflight[edition.id] = future
+
+    return future
+
+
+def scrape(url):
+    """
+    Scrapes the TCGPlayer mid price from a MagicCards.info page.
+    """
+    price = None
+
+    # Unfortunately we need JavaScript support.
+    session = dryscrape.Session()
+    session.visit(url)
+    response = session.body()
+
+    if response:
+        soup = BeautifulSoup(response, 'html.parser')
+        price_tag = soup.find('td', class_='TCGPPriceMid')
+
+        if price_tag and price_tag.a:
+            price = price_tag.a.string
+
+    return price
+
+
+def store(edition_id, price):
+    """
+    Writes a freshly scraped price to the cache and commits. If the price has
+    changed, so have the version and the value of the collection it belongs
+    to.
+    """
+    from cards import providers, stats
+    from cards.models import Price, Edition, User
+
+    cached = Price.query.filter(Price.edition_id == edition_id).scalar()
+    if not cached:
+        cached = Price(edition_id=edition_id)
+        db.session.add(cached)
+
+    if cached.price != price:
+        edition = Edition.query.get(edition_id)
+        db.session.query(User).filter(User.id == edition.user_id).update(
+            {User.version: User.version + 1}, synchronize_session=False
+        )
+
+        value = (edition.have or 0) * (
+            stats.price_value(price) - stats.price_value(cached.price)
+        )
+        if value and edition.card:
+            card = edition.card
+            stats.apply(edition.user_id, {}, {
+                key: [0, 0, value] for key in [
+                    ('total', ''), ('color', card.color), ('type', card.type),
+                    ('set', edition.set.name), ('rarity', edition.rarity)
+                ]
+            })
+
+    cached.price = price
+    cached.fetched_at = datetime.utcnow()
+    cached.source = providers.get().name
+
+    db.session.commit()
+
+
+def count(counter, n=1):
+    with _lock:
+        counters[counter] += n
+
+
+def statistics():
+    """
+    Returns a snapshot of the cache counters, as well as the queue length.
+    """
+    with _lock:
+        stats = dict(counters)
+        stats['queued'] = len(_pending)
+        stats['scraping'] = len(_inflight)
+
+    return stats
+
+
+def _fetch(edition_id):
+    """
+    Gets the price of an edition from the card provider (scraping it, for the
+    remote provider) and caches it, returning the price.
+    """
+    from cards import providers
+    from cards.models import Edition
+
+    start = time()
+    succeeded = False
+
+    try:
+        with app.app_context():
+            price = providers.get().price(Edition.query.get(edition_id))
+            store(edition_id, price)
+
+        count('refreshed')
+        succeeded = True
+        return price
+
+    except Exception as e:
+        count('errors')
+        print('Warning: Unable to refresh price of edition {}: {}'
+              .format(edition_id, e))
+        raise
+
+    finally:
+        with _lock:
+            _inflight.pop(edition_id, None)
+
+        for listener in listeners:
+            listener(edition_id, succeeded, time() - start)
+
+
+def _work():
+    while True:
+        edition_id = _queue.get()
+
+        try:
+            _fetch(edition_id)
+        except Exception:
+            pass    # Already reported.
+        finally:
+            with _lock:
+                _pending.discard(edition_id)
+            _queue.task_done()
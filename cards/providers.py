@@ -0,0 +1,157 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+from threading import Lock
+from os import path
+import json
+
+from cards import app, catalog, deckbrew, prices
+from cards.models import DECKBREW_IMAGE
+
+
+_provider = None
+_lock = Lock()
+
+
+class Provider(ABC):
+    """
+    Where card data comes from: the cards themselves (in the format returned
+    by DeckBrew), the release dates of sets, and the prices and images of
+    printings. Subclasses must implement every method (or they can't be
+    created).
+    """
+    # Recorded as the source of cached prices.
+    name = None
+
+    @abstractmethod
+    def find_card(self, name):
+        """
+        Returns the cards matching the specified name (only the exact match, if
+        there is one), like deckbrew.find_card.
+        """
+
+    @abstractmethod
+    def release_dates(self, set_names):
+        """
+        Returns a dictionary mapping each set name to its release date (or
+        None, if it's not known).
+        """
+
+    @abstractmethod
+    def price(self, edition):
+        """
+        Returns the current price of an edition (or None). This may be slow,
+        so it's only called by the price workers.
+        """
+
+    @abstractmethod
+    def image_url(self, edition):
+        """
+        Returns the URL of an image of an edition.
+        """
+
+
+class RemoteProvider(Provider):
+    """
+    Looks cards up in the local catalog or DeckBrew, release dates up on
+    Wikipedia, and scrapes prices from MagicCards.info.
+    """
+    name = 'MagicCards.info'
+
+    def find_card(self, name):
+        return deckbrew.find_card(name)
+
+    def release_dates(self, set_names):
+        return deckbrew.release_dates(set_names)
+
+    def price(self, edition):
+        return prices.scrape(edition.mci_url)
+
+    def image_url(self, edition):
+        return DECKBREW_IMAGE.format(edition.multiverse_id)
+
+
+class LocalProvider(Provider):
+    """
+    Serves everything from a dataset on disk, without touching the network.
+    The directory contains:
+
+        cards.json          A DeckBrew-format dump (like CATALOG_FILE).
+        release_dates.json  A dictionary mapping set names to release dates
+                            (as YYYY-MM-DD).
+        prices.json         A dictionary mapping Multiverse IDs to prices.
+                            Optional; editions not listed have no price.
+
+    Image URLs are built from image_url, which is formatted with the
+    edition's multiverse_id, set (code), and number.
+    """
+    name = 'Local'
+
+    def __init__(self, directory, image_url=DECKBREW_IMAGE):
+        self.directory = directory
+        self.image_url_format = image_url
+
+        catalog.load(path.join(directory, 'cards.json'))
+
+        with open(path.join(directory, 'release_dates.json'), 'r') as f:
+            self.dates = {
+                name: datetime.strptime(d, '%Y-%m-%d').date()
+                for name, d in json.load(f).items()
+            }
+
+        self.prices = {}
+        prices_file = path.join(directory, 'prices.json')
+        if path.exists(prices_file):
+            with open(prices_file, 'r') as f:
+                self.prices = {int(m): p for m, p in json.load(f).items()}
+
+    def find_card(self, name):
+        return deckbrew.find_card(name, search_cards=catalog.search,
+                                  find_printing=catalog.by_multiverse_id)
+
+    def release_dates(self, set_names):
+        return deckbrew.release_dates(set_names, index=self.dates)
+
+    def price(self, edition):
+        return self.prices.get(edition.multiverse_id)
+
+    def image_url(self, edition):
+        # Positional, so that DECKBREW_IMAGE works as a format too.
+        return self.image_url_format.format(
+            edition.multiverse_id, multiverse_id=edition.multiverse_id,
+            set=edition.set.code, number=edition.collector_number
+        )
+
+
+def get():
+    """
+    Returns the provider selected by CARD_PROVIDER ("remote", the default, or
+    "local"), creating it the first time this is called.
+    """
+    global _provider
+
+    if _provider is None:
+        with _lock:
+            if _provider is None:
+                kind = app.config.get('CARD_PROVIDER', 'remote')
+
+                if kind == 'remote':
+                    _provider = RemoteProvider()
+                elif kind == 'local':
+                    _provider = LocalProvider(
+                        app.config.get('LOCAL_DATA_DIR'),
+                        app.config.get('LOCAL_IMAGE_URL', DECKBREW_IMAGE)
+                    )
+                else:
+                    raise Exception('Unknown CARD_PROVIDER: {}'.format(kind))
+
+    return _provider
+
+
+def set_provider(provider):
+    """
+    Replaces the provider (with any Provider, configured or not).
+    """
+    global _provider
+
+    with _lock:
+        _provider = provider
@@ -0,0 +1,251 @@
+from collections import OrderedDict, defaultdict
+from datetime import date
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import contains_eager, joinedload
+import re
+
+from cards import db
+from cards.models import Statistic, Edition, Set
+
+
+# Groups are listed in the order they're displayed.
+GROUPS = ['total', 'set', 'color', 'type', 'rarity']
+
+
+def price_value(price):
+    """
+    Converts a scraped price (like "$1,234.50") to a whole number of cents.
+    Prices that are missing or can't be read are worth nothing.
+    """
+    if not price:
+        return 0
+
+    try:
+        return int(round(float(re.sub(r'[^0-9.]', '', price)) * 100))
+    except ValueError:
+        return 0
+
+
+def release_order(release_date, set_name):
+    """
+    Sort key for printings, in order of release (with printings from sets
+    whose release dates aren't known first).
+    """
+    return (release_date is not None, release_date or date.min, set_name)
+
+
+def latest_printing(editions):
+    """
+    Returns the most recently released of a card's editions. This is where
+    the copies of a card that are still needed are counted (for the set and
+    rarity statistics), just like when the collection is exported.
+    """
+    return max(
+        editions,
+        key=lambda e: release_order(e.set.release_date, e.set.name),
+        default=None
+    )
+
+
+def contributions(card, editions):
+    """
+    Returns what a card and its editions (whose sets and prices should already
+    be loaded) add to each statistic, as a dictionary mapping (group, key)
+    tuples to [owned, needed, value] lists.
+    """
+    if card is None:
+        return defaultdict(lambda: [0, 0, 0])
+
+    return tally(card.want, card.color, card.type, [
+        (e.have, e.set.name, e.set.release_date, e.rarity,
+         e.cached_price.price if e.cached_price else None)
+        for e in editions
+    ])
+
+
+def tally(want, color, type, editions):
+    """
+    Does the same as contributions, but from plain values (as read from the DB
+    without loading any objects): the card's want, color, and type, and its
+    editions as (have, set name, release date, rarity, price) tuples.
+    """
+    totals = defaultdict(lambda: [0, 0, 0])
+
+    owned = sum(edition[0] or 0 for edition in editions)
+    needed = max((want or 0) - owned, 0)
+    latest = max(
+        range(len(editions)),
+        key=lambda i: release_order(editions[i][2], editions[i][1]),
+        default=None
+    )
+
+    for key in [('total', ''), ('color', color), ('type', type)]:
+        totals[key][0] += owned
+        totals[key][1] += needed
+
+    for i, (have, set_name, release_date, rarity, price) in \
+            enumerate(editions):
+        value = (have or 0) * price_value(price)
+
+        for key in [('set', set_name), ('rarity', rarity)]:
+            totals[key][0] += have or 0
+            totals[key][1] += needed if i == latest else 0
+
+        for key in [('total', ''), ('color', color), ('type', type),
+                    ('set', set_name), ('rarity', rarity)]:
+            totals[key][2] += value
+
+    return totals
+
+
+def difference(before, after):
+    """
+    Returns the changes between two sets of contributions, as a dictionary
+    mapping (group, key) tuples to [owned, needed, value] lists (leaving out
+    those that didn't change).
+    """
+    changes = {}
+    for key in set(before) | set(after):
+        delta = [a - b for a, b in zip(after.get(key, [0, 0, 0]),
+                                       before.get(key, [0, 0, 0]))]
+        if any(delta):
+            changes[key] = delta
+
+    return changes
+
+
+def stage(user_id, before, after):
+    """
+    Adds the difference between two sets of contributions to the changes to
+    the user's statistics that are waiting in the session, so that cards
+    changed together cost one apply rather than one each. They're applied by
+    apply_staged (which controller.commit calls).
+    """
+    staged = db.session.info.setdefault('statistics', {}).setdefault(
+        user_id, defaultdict(lambda: [0, 0, 0])
+    )
+
+    for key, delta in difference(before, after).items():
+        staged[key] = [s + d for s, d in zip(staged[key], delta)]
+
+
+def apply_staged():
+    """
+    Applies (without committing) the changes waiting in the session.
+    """
+    for user_id, changes in db.session.info.pop('statistics', {}).items():
+        apply_changes(user_id, changes)
+
+
+def apply(user_id, before, after):
+    """
+    Adjusts a user's statistics by the difference between two sets of
+    contributions.
+    """
+    apply_changes(user_id, difference(before, after))
+
+
+def apply_changes(user_id, changes):
+    """
+    Adjusts a user's statistics by a dictionary like the one returned by
+    difference. The changes are made with UPDATE statements (rather than by
+    assigning to Statistic objects), so that concurrent changes aren't lost.
+    Statistics that don't exist yet are created.
+    """
+    changes = {key: delta for key, delta in changes.items() if any(delta)}
+
+    if not changes:
+        return
+
+    existing = {
+        (group, key): id for id, group, key in db.session.query(
+            Statistic.id, Statistic.group, Statistic.key
+        ).filter(
+            Statistic.user_id == user_id,
+            or_(*[and_(Statistic.group == group, Statistic.key == key)
+                  for group, key in changes])
+        )
+    }
+
+    for (group, key), (owned, needed, value) in changes.items():
+        if (group, key) in existing:
+            db.session.query(Statistic).filter(
+                Statistic.id == existing[(group, key)]
+            ).update({
+                Statistic.owned: Statistic.owned + owned,
+                Statistic.needed: Statistic.needed + needed,
+                Statistic.value: Statistic.value + value
+            }, synchronize_session=False)
+        else:
+            db.session.add(Statistic(
+                user_id=user_id, group=group, key=key, owned=owned,
+                needed=needed, value=value
+            ))
+
+
+def compute(user):
+    """
+    Computes all of a user's statistics from scratch (which means reading
+    every card, edition, and price in the collection). Returns a dictionary
+    like the one returned by contributions.
+    """
+    # Cards without any editions still need to be counted.
+    cards = {card.id: card for card in user.cards}
+    editions = defaultdict(list)
+
+    query = db.session.query(Edition).join(Set).filter(
+        Edition.user_id == user.id, Edition.card_id.isnot(None)
+    ).options(contains_eager(Edition.set), joinedload(Edition.cached_price))
+
+    for edition in query:
+        editions[edition.card_id].append(edition)
+
+    totals = defaultdict(lambda: [0, 0, 0])
+    for card_id, card in cards.items():
+        for key, values in contributions(card, editions[card_id]).items():
+            totals[key] = [t + v for t, v in zip(totals[key], values)]
+
+    return totals
+
+
+def rebuild(user, check=False):
+    """
+    Recomputes all of a user's statistics and returns a list of the ones that
+    were wrong, as ((group, key), stored, correct) tuples. Unless check is
+    True, the stored statistics are then replaced (without committing).
+    """
+    correct = compute(user)
+    stored = {
+        (s.group, s.key): [s.owned, s.needed, s.value]
+        for s in user.statistics
+    }
+
+    differences = [
+        (key, stored.get(key), correct.get(key))
+        for key in sorted(set(stored) | set(correct))
+        if stored.get(key, [0, 0, 0]) != correct.get(key, [0, 0, 0])
+    ]
+
+    if differences and not check:
+        user.statistics.delete(synchronize_session=False)
+        db.session.add_all(
+            Statistic(user_id=user.id, group=group, key=key, owned=owned,
+                      needed=needed, value=value)
+            for (group, key), (owned, needed, value) in correct.items()
+        )
+
+    return differences
+
+
+def summary(user):
+    """
+    Returns the user's statistics as an OrderedDict mapping each group to a
+    list of statistics (as dicts), most copies owned first.
+    """
+    groups = OrderedDict((group, []) for group in GROUPS)
+
+    for s in user.statistics.order_by(Statistic.owned.desc(), Statistic.key):
+        if s.owned or s.needed or s.value:
+            groups.setdefault(s.group, []).append(s.dict())
+
+    return groups
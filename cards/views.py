@@ -1,14 +1,21 @@
-from flask import render_template, flash, redirect, session, url_for, request
+from flask import (
+    render_template, flash, redirect, session, url_for, request, jsonify,
+    Response, stream_with_context
+)
 from flask.ext.login import login_user, logout_user, current_user, login_required
 from wtforms import BooleanField
 from wtforms.fields.html5 import IntegerField
 from wtforms.validators import NumberRange
-import ldap3
+import ldap3, json
 
-from cards import db, app, controller, lm
-from cards.forms import LoginForm, BrowseForm, DetailsForm, AddForm
-from cards.models import User, Set, Card, Edition
-from cards.authenticate import authenticate
+from cards import db, app, controller, lm, prices, jobs, stats, authenticate
+from cards.forms import (
+    LoginForm, BrowseForm, DetailsForm, AddForm, UpdateForm, IncrementForm
+)
+from cards.models import User, Card, Edition
+
+
+HEADERS = ['Card Name', 'Color', 'Type', 'Cost', 'H', 'W', 'N']
 
 
 @app.route('/')
@@ -33,14 +40,31 @@ def browse():
              if form.collection.data else []
     }
 
-    # TODO: Consider sending/receiving page numbers to keep queries shorter.
-
-    cards = controller.fetch(current_user, filters, 'set')
+    # Pages after the first are found using the cursor from the page before.
+    try:
+        page_number = int(form.page.data or 1)
+    except ValueError:
+        page_number = 1
+
+    # The cursor comes from the client, so it may not be valid. If it isn't,
+    # start over from the first page.
+    cursor = form.cursor.data or None
+    try:
+        if cursor:
+            controller.decode_cursor(cursor)
+    except ValueError:
+        page_number, cursor = 1, None
+
+    cards, paging = controller.fetch(
+        current_user, filters, 'set', page_size=app.config.get('PAGE_SIZE'),
+        page_number=page_number, cursor=cursor
+    )
     headers, submenu = build_submenu(filters)
 
     return render_template(
         "browse.html", title="Browse", user=current_user, form=form,
-        headers=headers, submenu=submenu, cards=cards
+        headers=headers, submenu=submenu, cards=cards, paging=paging,
+        increment_form=IncrementForm()
     )
 
 
@@ -48,16 +72,25 @@ def browse():
 @login_required
 def search():
     """
-    Search collection for a specific card.
+    Search collection for a specific card (by name, type line, or rules text).
     """
+    query = request.args.get('q', '')
 
-    # CODE HERE
-
-    # Bottom part of the page is just the browse page, but with a search bar at
-    # the top.
+    try:
+        page_number = int(request.args.get('page', 1))
+    except ValueError:
+        page_number = 1
 
+    cards, paging = controller.search(
+        current_user, query, page_size=app.config.get('PAGE_SIZE'),
+        page_number=page_number
+    )
 
-    return render_template("search.html", title="Search", user=current_user)
+    return render_template(
+        "search.html", title="Search", user=current_user, query=query,
+        headers=HEADERS, cards=cards, paging=paging,
+        increment_form=IncrementForm()
+    )
 
 
 @app.route('/details', methods=['GET', 'POST'])
@@ -99,6 +132,65 @@ def details():
     )
 
 
+@app.route('/details/prices')
+@login_required
+def details_prices():
+    """
+    Scrapes any missing or out-of-date prices for the printings of a card
+    (several at once, waiting no more than PRICE_REQUEST_TIMEOUT seconds) and
+    returns them as JSON, along with the sets whose prices are still pending.
+    """
+    name = request.args.get('card')
+    card = current_user.cards.filter(Card.name == name).scalar()
+
+    if not card:
+        return jsonify({'error': 'No card named {}.'.format(name)}), 404
+
+    editions = card.editions.all()
+    found, pending = prices.refresh_many(editions)
+
+    return jsonify({
+        'prices': {e.set.name: found[e.id] for e in editions if e.id in found},
+        'pending': [e.set.name for e in editions if e.id in pending]
+    })
+
+
+@app.route('/update/counts', methods=['POST'])
+@login_required
+def update_counts():
+    """
+    Changes the number of copies owned of several editions at once. The
+    changes field holds a JSON list of {"card", "set", "delta"} objects. The
+    new counts (and the totals of the cards) are returned as JSON.
+    """
+    form = IncrementForm()
+
+    if not form.validate_on_submit():
+        return jsonify({'error': 'Invalid request.'}), 400
+
+    try:
+        changes = [(c['card'], c['set'], int(c['delta']))
+                   for c in json.loads(form.changes.data)]
+        counts = controller.increment(current_user, changes)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    names = {name for name, set_name in counts}
+    cards = db.session.query(Card.name, Card.have, Card.need).filter(
+        Card.user_id == current_user.id, Card.name.in_(names)
+    )
+
+    return jsonify({
+        'editions': [
+            {'card': name, 'set': set_name, 'have': have}
+            for (name, set_name), have in counts.items()
+        ],
+        'cards': {
+            name: {'have': have, 'need': need} for name, have, need in cards
+        }
+    })
+
+
 @app.route('/add/card', methods=['GET', 'POST'])
 @login_required
 def add_card():
@@ -118,7 +210,13 @@ def add_card():
 
             if not cards:
                 # No cards were found. Warn, and have the user try again.
-                flash('No cards found matching "{}".'.format(form.data.name))
+                flash('No cards found matching "{}".'.format(form.name.data))
+
+                suggestions = controller.suggest_cards(form.name.data)
+                if suggestions:
+                    flash('Did you mean {}?'.format(' or '.join(
+                        '"{}"'.format(s) for s in suggestions
+                    )))
 
             else:
                 # Success! Exactly one card was found! Add it, then redirect.
@@ -158,26 +256,41 @@ def add_set():
     return render_template("set.html", title=card.name, user=current_user)
 
 
-@app.route('/update/database')
+@app.route('/update/database', methods=['GET', 'POST'])
 @login_required
 def update_db():
     """
-    Pulls all cards that exist in DeckBrew into the local database.
+    Pulls all cards that exist in DeckBrew into the local database. This takes
+    far too long to do during a request, so it's run as a background job (and
+    the page polls for its status).
     """
+    form = UpdateForm()
 
-    # CODE HERE
-
-    # Probably needs some sort of asynchronous call...? This is definitely
-    # going to time out. But how do we make sure that other stuff won't
-    # interfere with the update?
+    if form.validate_on_submit():
+        if form.action.data == 'cancel':
+            job = jobs.latest(current_user)
+            if job:
+                jobs.cancel(job)
+        else:
+            jobs.start(current_user)
 
+        return redirect(url_for('update_db'))
 
-    title = "Update Database"
     return render_template(
-        "update_db.html", title="Update Database", user=current_user
+        "update_db.html", title="Update Database", user=current_user,
+        form=form, job=job_status(jobs.latest(current_user))
     )
 
 
+@app.route('/update/database/status')
+@login_required
+def update_db_status():
+    """
+    Reports the progress of the most recent database update.
+    """
+    return jsonify(job_status(jobs.latest(current_user)))
+
+
 @app.route('/import')
 @login_required
 def import_csv():
@@ -196,17 +309,49 @@ def import_csv():
 @login_required
 def export_csv():
     """
-    Exports the card DB collection to a CSV file. (Only exports cards with "haves"
-    or "wants".)
+    Exports the card DB collection to a CSV file. (Only exports cards with
+    "haves" or "wants".) The file is streamed as it is generated.
     """
+    rows = controller.export_csv(current_user._get_current_object())
 
-    # CODE HERE
+    return Response(
+        stream_with_context(rows), mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=collection.csv'}
+    )
 
+
+@app.route('/stats')
+@login_required
+def statistics():
+    """
+    Summarize the collection: copies owned, copies needed, and value, overall
+    and by set, color, type, and rarity.
+    """
     return render_template(
-        "export.html", title="Export Collection to CSV", user=current_user
+        "stats.html", title="Statistics", user=current_user,
+        groups=stats.summary(current_user)
     )
 
 
+@app.route('/stats/collection')
+@login_required
+def collection_statistics():
+    """
+    Returns the collection statistics shown on the statistics page as JSON.
+    """
+    return jsonify(stats.summary(current_user))
+
+
+@app.route('/stats/prices')
+@login_required
+def price_statistics():
+    """
+    Reports how often prices are served from the cache, and how often they
+    need to be scraped.
+    """
+    return jsonify(prices.statistics())
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """
@@ -221,7 +366,8 @@ def login():
         return render_template('login.html', title="Log In", form=form)
 
     if form.validate_on_submit():
-        user = authenticate(form.username.data, form.password.data)
+        user = authenticate.authenticate(form.username.data,
+                                         form.password.data)
 
         if not user:
             flash('Login failed.')
@@ -242,20 +388,34 @@ def login():
 
 @app.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        authenticate.forget(current_user.id)
+
     logout_user()
     return redirect(url_for('index'))
 
 
 @lm.user_loader
 def load_user(id):
-    return User.query.get(id)
+    return authenticate.load_user(id)
+
+
+def job_status(job):
+    """
+    Describes a background job (if there is one), including whether it has
+    been interrupted.
+    """
+    if not job:
+        return None
+
+    return dict(job.dict(), status=jobs.status(job))
 
 
 def build_submenu(filters):
     """
     Defines what sub-menu items will be displayed in the "Browse" submenu.
     """
-    headers = ['Card Name', 'Color', 'Type', 'Cost', 'H', 'W', 'N']
+    headers = HEADERS
 
     submenu =  [
         {
@@ -283,8 +443,8 @@ def build_submenu(filters):
             'title': 'Set',
             'items': [
                 {'label': label, 'active': label in filters['set']}
-                for label in [s.name for s in
-                Set.query.order_by(Set.release_date.desc(), Set.name)]]
+                for label in controller.set_names()
+            ]
         },
     ]
 
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Written by Gem Newman. This work is licensed under a Creative Commons
+# Attribution-ShareAlike 4.0 International License.
+
+
+from argparse import ArgumentParser
+import sys
+
+from cards import controller, stats
+from cards.models import User
+
+
+def rebuild(user_ids=None, check=False):
+    """
+    Recomputes the collection statistics and card totals of the users
+    specified (or of every user) from scratch, reporting any that had drifted.
+    Returns the number of incorrect values found.
+    """
+    users = User.query
+    if user_ids:
+        users = users.filter(User.id.in_(user_ids))
+
+    count = 0
+    for user in users:
+        # The statistics are computed from editions, not from card totals, but
+        # both are checked here.
+        for name, stored, correct in controller.verify_have_totals(
+            user, fix=not check
+        ):
+            count += 1
+            print('{}: {} has {} copies but should have {}.'.format(
+                user.id, name, stored, correct
+            ))
+
+        differences = stats.rebuild(user, check=check)
+        count += len(differences)
+
+        for (group, key), stored, correct in differences:
+            print('{}: {} "{}" is {} but should be {}.'.format(
+                user.id, group, key, stored, correct
+            ))
+
+        print('{}: {} incorrect statistics{}.'.format(
+            user.id, len(differences),
+            '' if check or not differences else ' (rebuilt)'
+        ))
+
+    if not check:
+        controller.commit()
+
+    return count
+
+
+if __name__ == '__main__':
+    description = ("Rebuilds the collection statistics (owned, needed, and "
+                   "value) and card totals from scratch.")
+    parser = ArgumentParser(description=description)
+    parser.add_argument("user", help="Users to rebuild. Defaults to all.",
+                        nargs="*")
+    parser.add_argument("-c", "--check", help="Only reports statistics that "
+                        "are incorrect, without rebuilding them. Exits with "
+                        "status 1 if any are found.", action="store_true")
+    args = parser.parse_args()
+
+    if rebuild(args.user, args.check) and args.check:
+        sys.exit(1)
@@ -6,6 +6,11 @@ CSRF_ENABLED = True
 SECRET_KEY = urandom(30)
 PROPAGATE_EXCEPTIONS = True
 REMEMBER_COOKIE_NAME = 'cards_token'    # Needs to be unique server-wide.
+SLOW_REQUEST_THRESHOLD = 1              # Seconds before a request is logged.
+
+# Metrics (also available to ADMIN_USERS)
+METRICS_ALLOWED_ADDRESSES = ['127.0.0.1']
+METRICS_TOKEN = None                    # Sent as "Authorization: Bearer ...".
 
 # SQLAlchemy
 basedir = path.abspath(path.dirname(__file__))
@@ -15,6 +20,9 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 # LDAP
 LDAP_URI = 'ldap://YOUR.LDAP.URI'
 LDAP_SEARCH_BASE = 'ou=????,dc=????,dc=????'
+LDAP_CACHE_TTL = 300                    # Seconds a user's LDAP entry is kept.
+LDAP_POOL_SIZE = 4                      # Connections kept open for searches.
+USER_CACHE_TTL = 60                     # Seconds a logged-in user is kept.
 
 ADMIN_USERS = ['LDAP.USER.ID.HERE']
 
@@ -40,3 +48,41 @@ TYPES = [
 ]
 
 DEFAULT_WANT = 4
+PAGE_SIZE = 200                         # Editions per page when browsing.
+IMPORT_CHUNK_SIZE = 100                 # Cards per commit when importing.
+IMPORT_CONCURRENCY = 8                  # Concurrent lookups when importing.
+
+# Background Jobs
+JOB_WORKERS = 2
+JOB_TIMEOUT = 300                       # Seconds before a job is abandoned.
+
+# DeckBrew
+DECKBREW_RATE_LIMIT = 10                # Requests per second.
+DECKBREW_TIMEOUT = 10                   # Seconds before a request gives up.
+DECKBREW_RETRIES = 3
+DECKBREW_BACKOFF = 0.5                  # Seconds (doubled after each retry).
+DECKBREW_POOL_SIZE = 10                 # Connections kept alive.
+
+# Card Data
+CARD_PROVIDER = 'remote'                # Or 'local', to serve LOCAL_DATA_DIR.
+LOCAL_DATA_DIR = path.join(basedir, 'data')
+# Formatted with {multiverse_id}, {set} (code), and {number}.
+LOCAL_IMAGE_URL = ('https://image.deckbrew.com/mtg/multiverseid/'
+                   '{multiverse_id}.jpg')
+
+# Card Catalog
+CATALOG_FILE = path.join(basedir, 'cards.json')    # DeckBrew-format dump.
+CATALOG_SEARCH_LIMIT = 100              # Most partial matches returned.
+
+# Fuzzy Matching
+FUZZY_THRESHOLD = 0.7                   # Similarity needed to correct a name.
+
+# Release Dates
+RELEASE_DATE_FILE = path.join(basedir, 'release_dates.json')
+RELEASE_DATE_TTL = 60 * 60 * 24 * 7     # Seconds before Wikipedia is re-read.
+RELEASE_DATE_RETRY = 60 * 10            # Seconds to wait after a failure.
+
+# Prices
+PRICE_TTL = 60 * 60 * 24                # Seconds before a price is re-scraped.
+PRICE_WORKERS = 8                       # Prices scraped at once.
+PRICE_REQUEST_TIMEOUT = 10              # Seconds a page waits for prices.
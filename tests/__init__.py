@@ -0,0 +1,58 @@
+from copy import deepcopy
+from os import environ
+
+# Use the test configuration (an in-memory DB, with no catalog or release date
+# files) instead of config.py. This has to happen before cards is imported.
+environ.setdefault('CARDS_CONFIG', 'tests.config')
+
+from cards import db, models, controller, authenticate, providers
+
+
+def reset(*user_ids):
+    """
+    Empties the DB, and forgets the specified users (who may have been cached
+    by an earlier test).
+    """
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    models.create_search_index()
+    models.create_have_triggers()
+    controller.invalidate_set_names()
+
+    for user_id in user_ids:
+        authenticate.forget(user_id)
+
+
+def log_in(client, user_id):
+    """
+    Logs a test client in as a user, without going through LDAP.
+    """
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['_fresh'] = True
+
+
+class StubProvider(providers.Provider):
+    """
+    Serves a fixed list of cards (in the format returned by DeckBrew) and
+    release dates, with no prices or images.
+    """
+    name = 'Stub'
+
+    def __init__(self, cards=(), dates=None):
+        self.cards = {card['name'].lower(): card for card in cards}
+        self.dates = dates or {}
+
+    def find_card(self, name):
+        card = self.cards.get(name.lower())
+        return [deepcopy(card)] if card else []
+
+    def release_dates(self, set_names):
+        return {name: self.dates.get(name) for name in set_names}
+
+    def price(self, edition):
+        return None
+
+    def image_url(self, edition):
+        return ''
@@ -0,0 +1,12 @@
+from sample_config import *
+
+
+# Every test starts with an empty in-memory DB.
+SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+WTF_CSRF_ENABLED = False
+
+# Card data comes from the provider set by each test, never the network.
+CATALOG_FILE = None
+RELEASE_DATE_FILE = None
+PRICE_TTL = 60 * 60 * 24 * 365
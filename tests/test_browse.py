@@ -0,0 +1,85 @@
+from unittest import TestCase
+from sqlalchemy import event
+import re
+
+from tests import reset, log_in, StubProvider
+from cards import app, db, providers
+from benchmarks.generate import Collection
+
+
+class BrowseQueryTest(TestCase):
+    """
+    Browsing the collection should take the same number of queries however
+    large the collection is (rather than one or more per card or edition).
+    """
+    def setUp(self):
+        providers.set_provider(StubProvider())
+        self.client = app.test_client()
+        self.statements = 0
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+        providers.set_provider(None)
+
+    def count(self, *args):
+        self.statements += 1
+
+    def browse(self, data=None):
+        """
+        Requests the browse page (posting the form data, if there is any) and
+        returns the response and the number of statements executed.
+        """
+        self.statements = 0
+
+        if data is None:
+            response = self.client.get('/browse')
+        else:
+            response = self.client.post('/browse', data=data)
+
+        self.assertEqual(response.status_code, 200)
+        return response, self.statements
+
+    def queries(self, editions):
+        """
+        Creates a collection of about the specified number of editions, and
+        returns the number of statements executed by each of a series of
+        requests for the browse page.
+        """
+        reset('test')
+        Collection(editions, seed=1).write('test')
+        log_in(self.client, 'test')
+
+        counts = []
+
+        response, count = self.browse()
+        counts.append(count)
+
+        for collection in ['Owned', 'Wanted']:
+            response, count = self.browse({'collection': collection})
+            counts.append(count)
+
+        response, count = self.browse(
+            {'color': 'Red|Green', 'type': 'Creature'}
+        )
+        counts.append(count)
+
+        # The second page, by page number and by the cursor of the first.
+        response, count = self.browse({'page': '2'})
+        counts.append(count)
+
+        response, count = self.browse()
+        cursor = re.search(
+            r"goToPage\(2, '([^']+)'\)", response.get_data(as_text=True)
+        ).group(1)
+        response, count = self.browse({'page': '2', 'cursor': cursor})
+        self.assertIn('Page 2 of', response.get_data(as_text=True))
+        counts.append(count)
+
+        return counts
+
+    def test_queries_do_not_grow_with_collection(self):
+        small = self.queries(1000)
+        large = self.queries(5000)
+
+        self.assertEqual(small, large)
@@ -0,0 +1,151 @@
+from datetime import date
+from tempfile import NamedTemporaryFile
+from unittest import TestCase
+
+from tests import reset, StubProvider
+from cards import db, providers, controller, stats
+from cards.models import User, Set, Card
+
+
+CARDS = [
+    {
+        'name': 'Lightning Bolt',
+        'colors': ['red'],
+        'types': ['instant'],
+        'cost': '{R}',
+        'text': 'Lightning Bolt deals 3 damage to any target.',
+        'editions': [
+            {'set': 'Limited Edition Alpha', 'set_id': 'LEA',
+             'multiverse_id': 209, 'number': '161', 'rarity': 'common',
+             'layout': 'normal'},
+            {'set': 'Magic 2010', 'set_id': 'M10', 'multiverse_id': 191089,
+             'number': '146', 'rarity': 'common', 'layout': 'normal'},
+            {'set': 'Magic: The Gathering—Conspiracy', 'set_id': 'CNS',
+             'multiverse_id': 382298, 'number': '155', 'rarity': 'common',
+             'layout': 'normal'}
+        ]
+    },
+    {
+        'name': 'Serra Angel',
+        'colors': ['white'],
+        'types': ['creature'],
+        'subtypes': ['angel'],
+        'cost': '{3}{W}{W}',
+        'power': '4',
+        'toughness': '4',
+        'text': 'Flying, vigilance',
+        'editions': [
+            {'set': 'Limited Edition Alpha', 'set_id': 'LEA',
+             'multiverse_id': 39, 'number': '40', 'rarity': 'uncommon',
+             'layout': 'normal'},
+            {'set': 'Magic 2010', 'set_id': 'M10', 'multiverse_id': 189889,
+             'number': '34', 'rarity': 'uncommon', 'layout': 'normal'}
+        ]
+    },
+    {
+        'name': 'Sol Ring',
+        'colors': [],
+        'types': ['artifact'],
+        'cost': '{1}',
+        'text': '{T}: Add {C}{C}.',
+        'editions': [
+            {'set': 'Limited Edition Alpha', 'set_id': 'LEA',
+             'multiverse_id': 1, 'number': '269', 'rarity': 'uncommon',
+             'layout': 'normal'},
+            {'set': 'Judge Gift Program, 2016', 'set_id': 'J16',
+             'multiverse_id': None, 'number': '1', 'rarity': 'special',
+             'layout': 'normal'}
+        ]
+    },
+    {
+        'name': 'Dryad Arbor',
+        'colors': ['green'],
+        'types': ['land', 'creature'],
+        'supertypes': [],
+        'subtypes': ['forest', 'dryad'],
+        'cost': '',
+        'power': '1',
+        'toughness': '1',
+        'text': '',
+        'editions': [
+            {'set': 'Future Sight', 'set_id': 'FUT', 'multiverse_id': 136196,
+             'number': '174', 'rarity': 'uncommon', 'layout': 'normal'}
+        ]
+    }
+]
+
+DATES = {
+    'Limited Edition Alpha': date(1993, 8, 5),
+    'Future Sight': date(2007, 5, 4),
+    'Magic 2010': date(2009, 7, 17),
+    'Conspiracy': date(2014, 6, 6)
+}
+
+# The card name, then the want, have (by set), important, and uncertain
+# values to add it with.
+COLLECTION = [
+    ('Lightning Bolt', 8, {'Limited Edition Alpha': 1, 'Magic 2010': 4},
+     True, False),
+    ('Serra Angel', 2, {}, False, True),
+    ('Sol Ring', 1, {'Limited Edition Alpha': 0,
+                     'Judge Gift Program, 2016': 2}, False, False),
+    ('Dryad Arbor', 0, {'Future Sight': 3}, True, True)
+]
+
+
+class RoundTripTest(TestCase):
+    """
+    Exporting a collection and importing it into an empty DB should give back
+    exactly the same collection.
+    """
+    def setUp(self):
+        providers.set_provider(StubProvider(CARDS, DATES))
+        self.user = self.create_user()
+
+        for name, want, have, important, uncertain in COLLECTION:
+            controller.add_card(
+                self.user, name, want, have, important, uncertain
+            )
+
+    def tearDown(self):
+        providers.set_provider(None)
+
+    def create_user(self):
+        reset('test')
+        db.session.add(User(id='test', name='Test'))
+        db.session.commit()
+        return User.query.get('test')
+
+    def snapshot(self, user):
+        """
+        Returns everything in the user's collection, without the IDs that are
+        assigned as it's written.
+        """
+        sets = sorted(
+            (s.code, s.name, s.release_date) for s in user.sets
+        )
+        cards = sorted(
+            (c.name, c.color_byte, c.type_byte, c.type_line, c.text, c.cost,
+             c.power, c.toughness, c.want, c.important, c.uncertain,
+             c.have_total)
+            for c in user.cards
+        )
+        editions = sorted(
+            (e.card.name, e.set.name, e.multiverse_id or 0,
+             e.collector_number, e.rarity, e.have)
+            for e in user.editions.join(Set).join(Card)
+        )
+        return sets, cards, editions, stats.summary(user)
+
+    def test_export_then_import(self):
+        before = self.snapshot(self.user)
+
+        with NamedTemporaryFile('w', suffix='.csv') as f:
+            f.writelines(controller.export_csv(self.user))
+            f.flush()
+
+            user = self.create_user()
+            errors = controller.import_csv(user, f.name)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.snapshot(user), before)